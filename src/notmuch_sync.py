@@ -8,6 +8,7 @@ import asyncio
 import hashlib
 import json
 import logging
+import mmap
 import os
 import shlex
 import shutil
@@ -15,6 +16,8 @@ import struct
 import subprocess
 import sys
 
+from concurrent.futures import ThreadPoolExecutor
+
 from typing import Any, Dict, List, Tuple, Callable, IO
 
 from pathlib import Path
@@ -23,12 +26,25 @@ from select import select
 import notmuch2
 import xapian
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
 logging.basicConfig(format="[{asctime}] {message}", style="{")
 logger = logging.getLogger(__name__)
 
 transfer = {"read": 0, "write": 0}
 
-def digest(data: bytes) -> str:
+# files at least this large are memory-mapped for hashing and sending instead
+# of read
+MMAP_THRESHOLD = 1 << 20
+
+# precompiled wire formats: frame length prefix and mbsync file mtime
+LENGTH = struct.Struct("!I")
+MTIME = struct.Struct("!d")
+
+def digest(data: bytes | mmap.mmap) -> str:
     """
     Compute SHA256 digest of data, removing any X-TUID: lines. This is
     nececessary because mbsync adds these lines to keep track of internal
@@ -36,41 +52,72 @@ def digest(data: bytes) -> str:
     different.
 
     Args:
-        data (bytes): The data to compute the checsum for.
+        data (bytes or mmap): The data to compute the checsum for.
 
     Returns:
         The computed checksum.
     """
     pat = b"X-TUID: "
-    to_digest = data
-    start_idx = data.find(pat)
-    if start_idx != -1:
-        search_start = start_idx + len(pat)
-        end_idx = data.find(b"\n", search_start)
+    # hashlib's sha256 is backed by OpenSSL, which picks the fastest
+    # implementation for the CPU (e.g. SHA extensions) at runtime; feed it
+    # the parts around the X-TUID line instead of building a copy; the digest
+    # only identifies content, so it also works where FIPS mode restricts
+    # hashes used for security
+    h = hashlib.sha256(usedforsecurity=False)
+    with memoryview(data) as view:
+        start_idx = data.find(pat)
+        end_idx = -1
+        if start_idx != -1:
+            search_start = start_idx + len(pat)
+            end_idx = data.find(b"\n", search_start)
 
         if end_idx != -1:
-            to_digest = data[:start_idx] + data[end_idx + 1:]
+            h.update(view[:start_idx])
+            h.update(view[end_idx + 1:])
+        else:
+            h.update(view)
+    return h.hexdigest()
+
 
-    return hashlib.new("sha256", to_digest).hexdigest()
+def digest_file(fname: str | Path) -> str:
+    """
+    Compute the digest of a file's contents (see digest()). Large files are
+    memory-mapped so that their contents are hashed straight from the page
+    cache without first being copied into a bytes object.
 
+    Args:
+        fname (str or Path): The file to compute the checksum for.
 
-def write(data: bytes, stream: IO[bytes] | None) -> None:
+    Returns:
+        The computed checksum.
+    """
+    with open(fname, "rb") as f:
+        if os.fstat(f.fileno()).st_size < MMAP_THRESHOLD:
+            return digest(f.read())
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return digest(mm)
+
+
+def write(data: bytes | mmap.mmap, stream: IO[bytes] | None, flush: bool = True) -> None:
     """
     Write data to a stream with a 4-byte length prefix.
 
     Args:
-        data (bytes): The data to write.
+        data (bytes or mmap): The data to write.
         stream: A writable stream supporting .write() and .flush().
+        flush: Flush the stream after writing. Callers sending many frames in
+        a row can leave this to the stream's buffer and flush once at the end.
     """
     if stream is None:
         return
-    stream.write(struct.pack("!I", len(data)))
-    transfer["write"] += 4
+    stream.write(LENGTH.pack(len(data)))
+    transfer["write"] += LENGTH.size
     written = stream.write(data)
     if written < len(data):
         raise ValueError(f"Tried to write {len(data)} bytes, but wrote only {written}, aborting...")
     transfer["write"] += len(data)
-    stream.flush()
+    if flush:
+        stream.flush()
 
 
 def read(stream: IO[bytes] | None) -> bytes:
@@ -85,9 +132,9 @@ def read(stream: IO[bytes] | None) -> bytes:
     """
     if stream is None:
         return b''
-    size_data = stream.read(4)
-    transfer["read"] += 4
-    size = struct.unpack("!I", size_data)[0]
+    size_data = stream.read(LENGTH.size)
+    transfer["read"] += LENGTH.size
+    size = LENGTH.unpack(size_data)[0]
     data = stream.read(size)
     if len(data) < size:
         raise ValueError(f"Tried to read {size} bytes, but read only {len(data)}, aborting...")
@@ -95,6 +142,49 @@ def read(stream: IO[bytes] | None) -> bytes:
     return data
 
 
+def write_json(obj: Any, stream: IO[bytes] | None) -> None:
+    """
+    Serialize an object as compact JSON and write it to a stream with a
+    4-byte length prefix.
+
+    Args:
+        obj: The object to write.
+        stream: A writable stream supporting .write() and .flush().
+    """
+    if orjson is not None:
+        try:
+            write(orjson.dumps(obj), stream)
+            return
+        except TypeError:
+            # orjson rejects file names that are not valid UTF-8 and were
+            # surrogate-escaped by os.fsdecode(); json escapes them instead
+            pass
+    write(json.dumps(obj, separators=(",", ":")).encode("utf-8"), stream)
+
+
+def read_json(stream: IO[bytes] | None) -> Any:
+    """
+    Read a 4-byte length-prefixed JSON object from a stream.
+
+    Args:
+        stream: A readable stream supporting .read().
+
+    Returns:
+        The deserialized object.
+    """
+    # both parsers decode UTF-8 bytes themselves, no need for a decoded copy
+    # of the whole payload
+    data = read(stream)
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # escaped lone surrogates from non-UTF-8 file names, which only
+            # json accepts
+            pass
+    return json.loads(data)
+
+
 def run_async(m1: Callable[[], Any], m2: Callable[[], Any]) -> None:
     """
     Run two functions async. Used to read/write to streams at the same time.
@@ -145,6 +235,9 @@ def get_changes(
         pass
 
     logger.info("Previous sync revision %s, current revision %s.", rev_prev, revision.rev)
+    if rev_prev == revision.rev:
+        # nothing changed since last sync, no need to query
+        return {}
     return {msg.messageid: {"tags": list(msg.tags),
                             "files": [str(f).removeprefix(prefix) for f in msg.filenames()]}
                             for msg in db.messages(f"lastmod:{rev_prev + 1}..")}
@@ -180,12 +273,16 @@ def sync_tags(
             msg = db.find(mid)
             if msg.ghost:
                 continue
-            if tags != set(msg.tags):
+            tags_mine = set(msg.tags)
+            if tags != tags_mine:
                 logger.info("Setting tags %s for %s.", sorted(list(tags)), mid)
                 with msg.frozen():
                     changes += 1
-                    msg.tags.clear()
-                    for tag in sorted(list(tags)):
+                    # only touch the tags that differ, each one is a call
+                    # into libnotmuch
+                    for tag in sorted(list(tags_mine - tags)):
+                        msg.tags.discard(tag)
+                    for tag in sorted(list(tags - tags_mine)):
                         msg.tags.add(tag)
                     msg.tags.to_maildir_flags()
         except LookupError:
@@ -196,15 +293,31 @@ def sync_tags(
     return changes
 
 
+def dsync_opener(path: str, flags: int) -> int:
+    """
+    Opener for open() that makes writes synchronous (O_DSYNC where the
+    platform supports it), so that data is on disk once the write returns.
+
+    Args:
+        path: Path of the file to open.
+        flags: Flags computed by open().
+
+    Returns:
+        int: The file descriptor.
+    """
+    return os.open(path, flags | getattr(os, "O_DSYNC", 0), 0o666)
+
+
 def record_sync(fname: str, revision: notmuch2.DbRevision) -> None:
     """
-    Record last sync revision.
+    Record last sync revision. The file is written synchronously so that a
+    crash right after a sync cannot leave a stale revision behind.
 
     Args:
         fname: File to write to.
         revision: Revision/UUID to record.
     """
-    with open(fname, 'w', encoding="utf-8") as f:
+    with open(fname, 'w', encoding="utf-8", opener=dsync_opener) as f:
         logger.info("Writing last sync revision %s.", revision.rev)
         f.write(f"{revision.rev} {revision.uuid.decode()}")
 
@@ -257,11 +370,11 @@ def initial_sync(
 
     def _send_changes():
         logger.info("Sending local changes...")
-        write(json.dumps(changes["mine"]).encode("utf-8"), to_stream)
+        write_json(changes["mine"], to_stream)
 
     def _recv_changes():
         logger.info("Receiving remote changes...")
-        changes["theirs"] = json.loads(read(from_stream).decode("utf-8"))
+        changes["theirs"] = read_json(from_stream)
 
     run_async(_send_changes, _recv_changes)
 
@@ -310,9 +423,12 @@ def get_missing_files(
     # check which files we need to get digests for to determine if they've
     # been moved/copied
     hashes["req_mine"] = []
+    # messages found locally, so that each one is only looked up once
+    msgs = {}
     for mid in changes_theirs:
         try:
             msg = dbw.find(mid)
+            msgs[mid] = msg
             if msg.ghost:
                 continue
             fnames_theirs = changes_theirs[mid]["files"]
@@ -326,11 +442,11 @@ def get_missing_files(
     def _send_hashes_req():
         logger.info("Requesting %s hashes from remote...", len(hashes["req_mine"]))
         logger.debug("Requesting hashes %s", hashes["req_mine"])
-        write(json.dumps(hashes["req_mine"]).encode("utf-8"), to_stream)
+        write_json(hashes["req_mine"], to_stream)
 
     def _recv_hashes_req():
         logger.info("Receiving hash requests from remote...")
-        hashes["req_theirs"] = json.loads(read(from_stream).decode("utf-8"))
+        hashes["req_theirs"] = read_json(from_stream)
         logger.debug("Hashes requested by remote %s", hashes["req_theirs"])
 
     run_async(_send_hashes_req, _recv_hashes_req)
@@ -338,12 +454,15 @@ def get_missing_files(
     def _send_hashes():
         logger.info("Hashing %s requested files and sending to remote...",
                     len(hashes["req_theirs"]))
-        tmp = [digest(Path(os.path.join(prefix, f)).read_bytes()) for f in hashes["req_theirs"]]
-        write(json.dumps(tmp).encode("utf-8"), to_stream)
+        # hashlib releases the GIL while hashing, so files can be hashed in
+        # parallel
+        with ThreadPoolExecutor() as pool:
+            tmp = list(pool.map(digest_file, [os.path.join(prefix, f) for f in hashes["req_theirs"]]))
+        write_json(tmp, to_stream)
 
     def _recv_hashes():
         logger.info("Receiving hashes from remote...")
-        tmp = json.loads(read(from_stream).decode("utf-8"))
+        tmp = read_json(from_stream)
         hashes["theirs"] = dict(zip(hashes["req_mine"], tmp))
 
     run_async(_send_hashes, _recv_hashes)
@@ -351,7 +470,8 @@ def get_missing_files(
     # now actually determine changes and move/copy
     for mid in changes_theirs:
         try:
-            msg = dbw.find(mid)
+            # KeyError is a LookupError, same as not found in the DB
+            msg = msgs[mid]
             if msg.ghost:
                 ret[mid] = changes_theirs[mid]
                 continue
@@ -359,15 +479,19 @@ def get_missing_files(
             fnames_mine = [ str(f).removeprefix(prefix) for f in msg.filenames() ]
             missing_mine = set(fnames_theirs) - set(fnames_mine)
             if len(missing_mine) > 0:
-                hashes_mine = {str(f).removeprefix(prefix): digest(Path(f).read_bytes()) for f in msg.filenames()}
-                for f in changes_theirs[mid]["files"]:
+                # local files by digest, in file order, to look up moves/copies
+                files_by_digest: dict[str, List[str]] = {}
+                for f in fnames_mine:
+                    files_by_digest.setdefault(digest_file(os.path.join(prefix, f)), []).append(f)
+                fnames_theirs_set = set(fnames_theirs)
+                for f in fnames_theirs:
                     if f in missing_mine:
                         # check if it has been moved/copied
-                        matches = [x[0] for x in hashes_mine.items() if hashes["theirs"][f] == x[1]]
+                        matches = files_by_digest.get(hashes["theirs"][f], [])
                         if len(matches) > 0:
                             src = os.path.join(prefix, matches[0])
                             dst = os.path.join(prefix, f)
-                            if matches[0] in changes_theirs[mid]["files"]:
+                            if matches[0] in fnames_theirs_set:
                                 mcchanges += 1
                                 logger.info("Copying %s to %s.", src, dst)
                                 Path(dst).parent.mkdir(parents=True, exist_ok=True)
@@ -381,8 +505,8 @@ def get_missing_files(
                                 shutil.move(src, dst)
                                 fnames_mine.append(f)
                                 fnames_mine.remove(matches[0])
-                                hashes_mine[f] = hashes_mine[matches[0]]
-                                del hashes_mine[matches[0]]
+                                matches.pop(0)
+                                matches.append(f)
                                 dbw.add(dst)
                                 logger.info("Removing %s from DB.", src)
                                 dbw.remove(src)
@@ -393,9 +517,10 @@ def get_missing_files(
 
             # delete any files that are not there remotely after copy/move
             if mid not in changes_mine:
-                if len(set(fnames_mine).intersection(fnames_theirs)) == 0:
+                fnames_mine_set = set(fnames_mine)
+                if fnames_mine_set.isdisjoint(fnames_theirs):
                     raise ValueError(f"Message '{mid}' has {fnames_theirs} on remote and different {fnames_mine} locally!")
-                to_delete = set(fnames_mine) - set(fnames_theirs)
+                to_delete = fnames_mine_set.difference(fnames_theirs)
                 for f in to_delete:
                     fname = os.path.join(prefix, f)
                     dchanges += 1
@@ -409,16 +534,25 @@ def get_missing_files(
     return (ret, mcchanges, dchanges)
 
 
-def send_file(fname: str, stream: IO[bytes]) -> None:
+def send_file(fname: str, stream: IO[bytes], flush: bool = True) -> None:
     """
     Send a file's contents to a stream with 4-byte length prefix.
 
     Args:
         fname (str): Path to the file to send.
         stream: Writable stream.
+        flush: Flush the stream after writing (see write()).
     """
     with open(fname, "rb") as f:
-        write(f.read(), stream)
+        # almost all mails are small enough to be read in one go; larger ones
+        # are written to the stream straight from the page cache
+        if os.fstat(f.fileno()).st_size < MMAP_THRESHOLD:
+            write(f.read(), stream, flush)
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            write(mm, stream, flush)
 
 
 def recv_file(
@@ -476,11 +610,11 @@ def sync_files(
 
     def _send_fnames():
         logger.info("Sending file names missing on local...")
-        write(json.dumps([f["name"] for f in files["mine"]]).encode("utf-8"), to_stream)
+        write_json([f["name"] for f in files["mine"]], to_stream)
 
     def _recv_fnames():
         logger.info("Receiving file names missing on remote...")
-        files["theirs"] = json.loads(read(from_stream).decode("utf-8"))
+        files["theirs"] = read_json(from_stream)
 
     run_async(_send_fnames, _recv_fnames)
 
@@ -490,7 +624,11 @@ def sync_files(
         for idx, fname in enumerate(files["theirs"]):
             logger.info("%s/%s Sending %s...", idx + 1, len(files["theirs"]),
                         fname)
-            send_file(os.path.join(prefix, fname), to_stream)
+            send_file(os.path.join(prefix, fname), to_stream, flush=False)
+        # the other side only reads here, so there is no need to push out
+        # every file on its own
+        if to_stream is not None:
+            to_stream.flush()
 
     def _recv_files():
         for idx, f in enumerate(files["mine"]):
@@ -535,11 +673,14 @@ def get_ids(prefix: str) -> List[str]:
 
     logger.info("Getting all message IDs from DB...")
     ghosts = {p.docid for p in db.postlist("Tghost")} # type: ignore[attr-defined]
-    all_docs = set(range(1, db.get_lastdocid() + 1))
-    for doc_id in all_docs - ghosts:
+    # walk the docids in order instead of materializing a set of all of them
+    # just to subtract the (usually few) ghosts
+    get_document = db.get_document
+    for doc_id in range(1, db.get_lastdocid() + 1):
+        if doc_id in ghosts:
+            continue
         try:
-            doc = db.get_document(doc_id)
-            value = doc.get_value(1)
+            value = get_document(doc_id).get_value(1)
             if value:
                 message_ids.append(value.decode("utf-8"))
         except xapian.DocNotFoundError:
@@ -583,7 +724,7 @@ def sync_deletes_local(
 
     def _recv_ids():
         logger.info("Receiving all message IDs from remote...")
-        ids["theirs"] = json.loads(read(from_stream).decode("utf-8"))
+        ids["theirs"] = read_json(from_stream)
 
     run_async(_get_ids, _recv_ids)
 
@@ -593,7 +734,7 @@ def sync_deletes_local(
         to_del_remote = list(set(ids["theirs"]) - set(ids["mine"]))
         logger.debug("Remote IDs to be deleted %s.", to_del_remote)
         logger.info("Sending message IDs to be deleted to remote...")
-        write(json.dumps(to_del_remote).encode("utf-8"), to_stream)
+        write_json(to_del_remote, to_stream)
 
     def _recv_del_ids():
         to_del = set(ids["mine"]) - set(ids["theirs"])
@@ -651,9 +792,9 @@ def sync_deletes_remote(
     """
     dels = 0
     ids = get_ids(prefix)
-    write(json.dumps(ids).encode("utf-8"), to_stream)
+    write_json(ids, to_stream)
 
-    to_del = json.loads(read(from_stream).decode("utf-8"))
+    to_del = read_json(from_stream)
     with notmuch2.Database(mode=notmuch2.Database.MODE.READ_WRITE) as dbw:
         for mid in to_del:
             try:
@@ -702,7 +843,7 @@ def sync_mbsync_local(
 
     def _recv_mbsync():
         logger.info("Receiving mbsync file stats from remote...")
-        mbsync["theirs"] = json.loads(read(from_stream).decode("utf-8"))
+        mbsync["theirs"] = read_json(from_stream)
 
     run_async(_get_mbsync, _recv_mbsync)
 
@@ -712,7 +853,7 @@ def sync_mbsync_local(
             if (f in mbsync["theirs"] and mbsync["theirs"][f] > mbsync["mine"][f]) ]
     pull += list(set(mbsync["theirs"].keys()) - set(mbsync["mine"].keys()))
     logger.debug("Local mbsync files to be updated from remote %s.", pull)
-    write(json.dumps(pull).encode("utf-8"), to_stream)
+    write_json(pull, to_stream)
 
     def _send_mbsync_files():
         push = [ f for f in mbsync["theirs"].keys()
@@ -721,23 +862,24 @@ def sync_mbsync_local(
 
         logger.debug("mbsync files to update on remote %s.", push)
         logger.info("Sending %s mbsync files to remote...", len(push))
-        write(json.dumps(push).encode("utf-8"), to_stream)
+        write_json(push, to_stream)
         for idx, f in enumerate(push):
             logger.debug("%s/%s Sending mbsync file %s to remote...", idx + 1,
                          len(push), f)
-            to_stream.write(struct.pack("!d", mbsync["mine"][f]))
+            to_stream.write(MTIME.pack(mbsync["mine"][f]))
+            transfer["write"] += MTIME.size
+            send_file(os.path.join(prefix, f), to_stream, flush=False)
+        if to_stream is not None:
             to_stream.flush()
-            transfer["write"] += 8
-            send_file(os.path.join(prefix, f), to_stream)
 
     def _recv_mbsync_files():
         logger.info("Receiving %s mbsync files from remote...", len(pull))
         for idx, f in enumerate(pull):
             logger.debug("%s/%s Receiving mbsync file %s from remote...",
                          idx + 1, len(pull), f)
-            mtime_data = from_stream.read(8)
-            transfer["read"] += 8
-            mtime = struct.unpack("!d", mtime_data)[0]
+            mtime_data = from_stream.read(MTIME.size)
+            transfer["read"] += MTIME.size
+            mtime = MTIME.unpack(mtime_data)[0]
             fname = os.path.join(prefix, f)
             recv_file(fname, from_stream, overwrite_raise=False)
             os.utime(fname, (mtime, mtime))
@@ -763,23 +905,24 @@ def sync_mbsync_remote(
     mbsync = { str(f).removeprefix(prefix): f.stat().st_mtime
                for pat in [".uidvalidity", ".mbsyncstate"]
                for f in Path(prefix).rglob(pat) }
-    write(json.dumps(mbsync).encode("utf-8"), to_stream)
-    push = json.loads(read(from_stream).decode("utf-8"))
+    write_json(mbsync, to_stream)
+    push = read_json(from_stream)
 
     def _send_mbsync_files():
         for f in push:
             fname = os.path.join(prefix, f)
-            to_stream.write(struct.pack("!d", Path(fname).stat().st_mtime))
+            to_stream.write(MTIME.pack(Path(fname).stat().st_mtime))
+            transfer["write"] += MTIME.size
+            send_file(fname, to_stream, flush=False)
+        if to_stream is not None:
             to_stream.flush()
-            transfer["write"] += 8
-            send_file(fname, to_stream)
 
     def _recv_mbsync_files():
-        pull = json.loads(read(from_stream).decode("utf-8"))
+        pull = read_json(from_stream)
         for f in pull:
-            mtime_data = from_stream.read(8)
-            transfer["read"] += 8
-            mtime = struct.unpack("!d", mtime_data)[0]
+            mtime_data = from_stream.read(MTIME.size)
+            transfer["read"] += MTIME.size
+            mtime = MTIME.unpack(mtime_data)[0]
             fname = os.path.join(prefix, f)
             recv_file(fname, from_stream, overwrite_raise=False)
             os.utime(fname, (mtime, mtime))
@@ -836,6 +979,8 @@ def sync_local(args: argparse.Namespace) -> None:
 
     with subprocess.Popen(
                 cmd,
+                # large enough to batch the many small frames of a sync
+                bufsize=1 << 16,
                 stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE
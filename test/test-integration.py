@@ -3,11 +3,20 @@ import os
 import socket
 import re
 import shutil
-import time
+from collections import namedtuple
 from pathlib import Path
 
 from tempfile import TemporaryDirectory
 
+import notmuch2
+
+SyncStats = namedtuple("SyncStats", ["new_messages", "new_files", "copied_moved",
+                                     "deleted_files", "tag_changes", "deleted_messages"])
+NO_OP = SyncStats(0, 0, 0, 0, 0, 0)
+SUMMARY = re.compile(r"(local|remote): +(\d+) new messages,\t(\d+) new files,\t(\d+) files copied/moved,"
+                     r"\t(\d+) files deleted,\t(\d+) messages with tag changes,\t(\d+) messages deleted")
+
+
 def write_conf(path):
     conf_path = os.path.join(path, ".notmuch-config")
     with open(conf_path, "w", encoding="utf-8") as f:
@@ -29,6 +38,16 @@ def sync(shell, local_conf, remote_conf, verbose=False, delete=False, mbsync=Fal
     return res.stderr
 
 
+def parse_sync(out):
+    stats = {m[1]: SyncStats(*map(int, m.groups()[1:])) for m in SUMMARY.finditer(out)}
+    return (stats["local"], stats["remote"])
+
+
+def tag_add(path, mid, tag):
+    with notmuch2.Database(path, mode=notmuch2.Database.MODE.READ_WRITE) as db:
+        db.find(mid).tags.add(tag)
+
+
 def test_sync(shell):
     with TemporaryDirectory() as local:
         with TemporaryDirectory() as remote:
@@ -46,27 +65,19 @@ def test_sync(shell):
             assert rsum[0] == "4"
             assert rsum[2] == "5\n"
 
-            out = sync(shell, local_conf, remote_conf).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
+            assert parse_sync(sync(shell, local_conf, remote_conf)) == (NO_OP, NO_OP)
 
-            local_sync_file = os.path.join(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
-            assert os.path.exists(local_sync_file)
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"5 {lsum[1]}"
+            local_sync_file = Path(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
+            assert local_sync_file.exists()
+            assert local_sync_file.read_text(encoding="utf-8") == f"5 {lsum[1]}"
 
-            remote_sync_file = os.path.join(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
-            assert os.path.exists(remote_sync_file)
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"5 {rsum[1]}"
+            remote_sync_file = Path(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
+            assert remote_sync_file.exists()
+            assert remote_sync_file.read_text(encoding="utf-8") == f"5 {rsum[1]}"
 
-            out = sync(shell, local_conf, remote_conf).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"5 {lsum[1]}"
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"5 {rsum[1]}"
+            assert parse_sync(sync(shell, local_conf, remote_conf)) == (NO_OP, NO_OP)
+            assert local_sync_file.read_text(encoding="utf-8") == f"5 {lsum[1]}"
+            assert remote_sync_file.read_text(encoding="utf-8") == f"5 {rsum[1]}"
 
             lsum = shell.run("notmuch", "count", "--lastmod", env={"NOTMUCH_CONFIG": local_conf}).stdout.split('\t')
             assert lsum[2] == "5\n"
@@ -91,17 +102,13 @@ def test_sync_tags(shell):
             assert rsum[0] == "4"
             assert rsum[2] == "5\n"
 
-            out = sync(shell, local_conf, remote_conf).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
-            local_sync_file = os.path.join(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
-            assert os.path.exists(local_sync_file)
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"5 {lsum[1]}"
-            remote_sync_file = os.path.join(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
-            assert os.path.exists(remote_sync_file)
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"5 {rsum[1]}"
+            assert parse_sync(sync(shell, local_conf, remote_conf)) == (NO_OP, NO_OP)
+            local_sync_file = Path(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
+            assert local_sync_file.exists()
+            assert local_sync_file.read_text(encoding="utf-8") == f"5 {lsum[1]}"
+            remote_sync_file = Path(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
+            assert remote_sync_file.exists()
+            assert remote_sync_file.read_text(encoding="utf-8") == f"5 {rsum[1]}"
 
             assert shell.run("notmuch", "tag", "+local", "id:874llc2bkp.fsf@curie.anarc.at",
                              env={"NOTMUCH_CONFIG": local_conf}).returncode == 0
@@ -122,9 +129,7 @@ def test_sync_tags(shell):
             rsum = shell.run("notmuch", "count", "--lastmod", env={"NOTMUCH_CONFIG": remote_conf}).stdout.split('\t')
             assert rsum[2] == "8\n"
 
-            out = sync(shell, local_conf, remote_conf).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t3 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t3 messages with tag changes,\t0 messages deleted" in out[1]
+            assert parse_sync(sync(shell, local_conf, remote_conf)) == (SyncStats(0, 0, 0, 0, 3, 0), SyncStats(0, 0, 0, 0, 3, 0))
 
             assert shell.run("notmuch", "search", "--output=tags", "--format=json", "id:874llc2bkp.fsf@curie.anarc.at",
                              env={"NOTMUCH_CONFIG": local_conf}).data == ["attachment", "local"]
@@ -143,19 +148,15 @@ def test_sync_tags(shell):
             assert shell.run("notmuch", "search", "--output=tags", "--format=json", "id:87d1dajhgf.fsf@example.net",
                              env={"NOTMUCH_CONFIG": remote_conf}).data == ["remote", "unread"]
 
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"11 {lsum[1]}"
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"11 {rsum[1]}"
+            assert local_sync_file.read_text(encoding="utf-8") == f"11 {lsum[1]}"
+            assert remote_sync_file.read_text(encoding="utf-8") == f"11 {rsum[1]}"
 
             lsum = shell.run("notmuch", "count", "--lastmod", env={"NOTMUCH_CONFIG": local_conf}).stdout.split('\t')
             assert lsum[2] == "11\n"
             rsum = shell.run("notmuch", "count", "--lastmod", env={"NOTMUCH_CONFIG": remote_conf}).stdout.split('\t')
             assert rsum[2] == "11\n"
 
-            out = sync(shell, local_conf, remote_conf).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
+            assert parse_sync(sync(shell, local_conf, remote_conf)) == (NO_OP, NO_OP)
 
 
 def test_sync_tags_files_verbose(shell):
@@ -213,7 +214,7 @@ def test_sync_tags_files_verbose(shell):
             assert 'Getting change numbers from remote...' in out[25]
             assert 'local:  1 new messages,\t1 new files,\t0 files copied/moved,\t0 files deleted,\t2 messages with tag changes,\t0 messages deleted' in out[26]
             assert 'remote: 1 new messages,\t1 new files,\t0 files copied/moved,\t0 files deleted,\t2 messages with tag changes,\t0 messages deleted' in out[27]
-            assert '9098/4288 bytes received from/sent to remote.' in out[28]
+            assert '9081/4272 bytes received from/sent to remote.' in out[28]
 
 
 def test_sync_tags_files(shell):
@@ -253,9 +254,7 @@ def test_sync_tags_files(shell):
             rsum = shell.run("notmuch", "count", "--lastmod", env={"NOTMUCH_CONFIG": remote_conf}).stdout.split('\t')
             assert rsum[2] == "4\n"
 
-            out = sync(shell, local_conf, remote_conf).split('\n')
-            assert "local:  2 new messages,\t2 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 2 new messages,\t3 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
+            assert parse_sync(sync(shell, local_conf, remote_conf)) == (SyncStats(2, 2, 0, 0, 0, 0), SyncStats(2, 3, 0, 0, 0, 0))
 
             assert Path(os.path.join(local, "mails", "attachment.eml")).exists()
             assert Path(os.path.join(local, "mails", "calendar.eml")).exists()
@@ -279,15 +278,13 @@ def test_sync_tags_files(shell):
             assert shell.run("notmuch", "search", "--output=tags", "--format=json", "id:87d1dajhgf.fsf@example.net",
                              env={"NOTMUCH_CONFIG": remote_conf}).data == ["local"]
 
-            local_sync_file = os.path.join(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
-            assert os.path.exists(local_sync_file)
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"9 {lsum[1]}"
+            local_sync_file = Path(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
+            assert local_sync_file.exists()
+            assert local_sync_file.read_text(encoding="utf-8") == f"9 {lsum[1]}"
 
-            remote_sync_file = os.path.join(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
-            assert os.path.exists(remote_sync_file)
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"9 {rsum[1]}"
+            remote_sync_file = Path(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
+            assert remote_sync_file.exists()
+            assert remote_sync_file.read_text(encoding="utf-8") == f"9 {rsum[1]}"
 
             # we record the last sync before transferring files and
             # adding/tagging them, so the revision after finished sync is higher
@@ -296,13 +293,9 @@ def test_sync_tags_files(shell):
             rsum = shell.run("notmuch", "count", "--lastmod", env={"NOTMUCH_CONFIG": remote_conf}).stdout.split('\t')
             assert rsum[2] == "9\n"
 
-            out = sync(shell, local_conf, remote_conf).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"9 {lsum[1]}"
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"9 {rsum[1]}"
+            assert parse_sync(sync(shell, local_conf, remote_conf)) == (NO_OP, NO_OP)
+            assert local_sync_file.read_text(encoding="utf-8") == f"9 {lsum[1]}"
+            assert remote_sync_file.read_text(encoding="utf-8") == f"9 {rsum[1]}"
 
 
 def test_sync_tags_files_copied(shell):
@@ -338,9 +331,7 @@ def test_sync_tags_files_copied(shell):
             assert rsum[0] == "3"
             assert rsum[2] == "6\n"
 
-            out = sync(shell, local_conf, remote_conf).split('\n')
-            assert "local:  2 new messages,\t2 new files,\t0 files copied/moved,\t0 files deleted,\t1 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 1 new messages,\t1 new files,\t1 files copied/moved,\t0 files deleted,\t1 messages with tag changes,\t0 messages deleted" in out[1]
+            assert parse_sync(sync(shell, local_conf, remote_conf)) == (SyncStats(2, 2, 0, 0, 1, 0), SyncStats(1, 1, 1, 0, 1, 0))
 
             assert Path(os.path.join(local, "mails", "attachment.eml")).exists()
             assert Path(os.path.join(local, "mails", "calendar.eml")).exists()
@@ -364,15 +355,13 @@ def test_sync_tags_files_copied(shell):
             assert shell.run("notmuch", "search", "--output=tags", "--format=json", "id:87d1dajhgf.fsf@example.net",
                              env={"NOTMUCH_CONFIG": remote_conf}).data == ["local", "remote"]
 
-            local_sync_file = os.path.join(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
-            assert os.path.exists(local_sync_file)
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"10 {lsum[1]}"
+            local_sync_file = Path(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
+            assert local_sync_file.exists()
+            assert local_sync_file.read_text(encoding="utf-8") == f"10 {lsum[1]}"
 
-            remote_sync_file = os.path.join(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
-            assert os.path.exists(remote_sync_file)
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"10 {rsum[1]}"
+            remote_sync_file = Path(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
+            assert remote_sync_file.exists()
+            assert remote_sync_file.read_text(encoding="utf-8") == f"10 {rsum[1]}"
 
             # we record the last sync before transferring files and
             # adding/tagging them, so the revision after finished sync is higher
@@ -381,13 +370,9 @@ def test_sync_tags_files_copied(shell):
             rsum = shell.run("notmuch", "count", "--lastmod", env={"NOTMUCH_CONFIG": remote_conf}).stdout.split('\t')
             assert rsum[2] == "10\n"
 
-            out = sync(shell, local_conf, remote_conf).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"10 {lsum[1]}"
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"10 {rsum[1]}"
+            assert parse_sync(sync(shell, local_conf, remote_conf)) == (NO_OP, NO_OP)
+            assert local_sync_file.read_text(encoding="utf-8") == f"10 {lsum[1]}"
+            assert remote_sync_file.read_text(encoding="utf-8") == f"10 {rsum[1]}"
 
 
 def test_sync_tags_files_moved(shell):
@@ -424,9 +409,7 @@ def test_sync_tags_files_moved(shell):
             assert rsum[0] == "3"
             assert rsum[2] == "6\n"
 
-            out = sync(shell, local_conf, remote_conf).split('\n')
-            assert "local:  2 new messages,\t2 new files,\t0 files copied/moved,\t0 files deleted,\t1 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 1 new messages,\t1 new files,\t0 files copied/moved,\t0 files deleted,\t1 messages with tag changes,\t0 messages deleted" in out[1]
+            assert parse_sync(sync(shell, local_conf, remote_conf)) == (SyncStats(2, 2, 0, 0, 1, 0), SyncStats(1, 1, 0, 0, 1, 0))
 
             assert Path(os.path.join(local, "mails", "attachment.eml")).exists()
             assert Path(os.path.join(local, "mails", "calendar.eml")).exists()
@@ -449,15 +432,13 @@ def test_sync_tags_files_moved(shell):
             assert shell.run("notmuch", "search", "--output=tags", "--format=json", "id:87d1dajhgf.fsf@example.net",
                              env={"NOTMUCH_CONFIG": remote_conf}).data == ["local", "remote"]
 
-            local_sync_file = os.path.join(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
-            assert os.path.exists(local_sync_file)
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"9 {lsum[1]}"
+            local_sync_file = Path(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
+            assert local_sync_file.exists()
+            assert local_sync_file.read_text(encoding="utf-8") == f"9 {lsum[1]}"
 
-            remote_sync_file = os.path.join(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
-            assert os.path.exists(remote_sync_file)
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"9 {rsum[1]}"
+            remote_sync_file = Path(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
+            assert remote_sync_file.exists()
+            assert remote_sync_file.read_text(encoding="utf-8") == f"9 {rsum[1]}"
 
             # we record the last sync before transferring files and
             # adding/tagging them, so the revision after finished sync is higher
@@ -472,13 +453,9 @@ def test_sync_tags_files_moved(shell):
             assert lsum[2] == "11\n"
             assert not Path(os.path.join(remote, "mails", "html-only1.eml")).exists()
 
-            out = sync(shell, local_conf, remote_conf).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t1 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"11 {lsum[1]}"
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"11 {rsum[1]}"
+            assert parse_sync(sync(shell, local_conf, remote_conf)) == (NO_OP, SyncStats(0, 0, 1, 0, 0, 0))
+            assert local_sync_file.read_text(encoding="utf-8") == f"11 {lsum[1]}"
+            assert remote_sync_file.read_text(encoding="utf-8") == f"11 {rsum[1]}"
 
             assert not Path(os.path.join(remote, "mails", "html-only.eml")).exists()
             assert Path(os.path.join(remote, "mails", "html-only1.eml")).exists()
@@ -490,13 +467,9 @@ def test_sync_tags_files_moved(shell):
             assert rsum[0] == "4"
             assert rsum[2] == "11\n"
 
-            out = sync(shell, local_conf, remote_conf).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"11 {lsum[1]}"
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"11 {rsum[1]}"
+            assert parse_sync(sync(shell, local_conf, remote_conf)) == (NO_OP, NO_OP)
+            assert local_sync_file.read_text(encoding="utf-8") == f"11 {lsum[1]}"
+            assert remote_sync_file.read_text(encoding="utf-8") == f"11 {rsum[1]}"
 
 
 def test_sync_tags_files_moved_twice(shell):
@@ -533,9 +506,7 @@ def test_sync_tags_files_moved_twice(shell):
             assert rsum[0] == "3"
             assert rsum[2] == "6\n"
 
-            out = sync(shell, local_conf, remote_conf).split('\n')
-            assert "local:  2 new messages,\t2 new files,\t1 files copied/moved,\t0 files deleted,\t1 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 1 new messages,\t1 new files,\t0 files copied/moved,\t0 files deleted,\t1 messages with tag changes,\t0 messages deleted" in out[1]
+            assert parse_sync(sync(shell, local_conf, remote_conf)) == (SyncStats(2, 2, 1, 0, 1, 0), SyncStats(1, 1, 0, 0, 1, 0))
 
             assert Path(os.path.join(local, "mails", "attachment.eml")).exists()
             assert Path(os.path.join(local, "mails", "calendar.eml")).exists()
@@ -561,15 +532,13 @@ def test_sync_tags_files_moved_twice(shell):
             assert shell.run("notmuch", "search", "--output=tags", "--format=json", "id:87d1dajhgf.fsf@example.net",
                              env={"NOTMUCH_CONFIG": remote_conf}).data == ["local", "remote"]
 
-            local_sync_file = os.path.join(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
-            assert os.path.exists(local_sync_file)
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"11 {lsum[1]}"
+            local_sync_file = Path(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
+            assert local_sync_file.exists()
+            assert local_sync_file.read_text(encoding="utf-8") == f"11 {lsum[1]}"
 
-            remote_sync_file = os.path.join(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
-            assert os.path.exists(remote_sync_file)
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"9 {rsum[1]}"
+            remote_sync_file = Path(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
+            assert remote_sync_file.exists()
+            assert remote_sync_file.read_text(encoding="utf-8") == f"9 {rsum[1]}"
 
             # we record the last sync before transferring files and
             # adding/tagging them, so the revision after finished sync is higher
@@ -578,13 +547,9 @@ def test_sync_tags_files_moved_twice(shell):
             rsum = shell.run("notmuch", "count", "--lastmod", env={"NOTMUCH_CONFIG": remote_conf}).stdout.split('\t')
             assert rsum[2] == "9\n"
 
-            out = sync(shell, local_conf, remote_conf).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"11 {lsum[1]}"
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"9 {rsum[1]}"
+            assert parse_sync(sync(shell, local_conf, remote_conf)) == (NO_OP, NO_OP)
+            assert local_sync_file.read_text(encoding="utf-8") == f"11 {lsum[1]}"
+            assert remote_sync_file.read_text(encoding="utf-8") == f"9 {rsum[1]}"
 
 
 def test_sync_tags_files_none_remote(shell):
@@ -610,9 +575,7 @@ def test_sync_tags_files_none_remote(shell):
             assert shell.run("notmuch", "tag", "+local", "id:874llc2bkp.fsf@curie.anarc.at",
                              env={"NOTMUCH_CONFIG": local_conf}).returncode == 0
 
-            out = sync(shell, local_conf, remote_conf).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 4 new messages,\t5 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
+            assert parse_sync(sync(shell, local_conf, remote_conf)) == (NO_OP, SyncStats(4, 5, 0, 0, 0, 0))
 
             assert Path(os.path.join(remote, "mails", "attachment.eml")).exists()
             assert Path(os.path.join(remote, "mails", "calendar.eml")).exists()
@@ -636,15 +599,13 @@ def test_sync_tags_files_none_remote(shell):
             assert shell.run("notmuch", "search", "--output=tags", "--format=json", "id:87d1dajhgf.fsf@example.net",
                              env={"NOTMUCH_CONFIG": remote_conf}).data == ["local"]
 
-            local_sync_file = os.path.join(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
-            assert os.path.exists(local_sync_file)
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"9 {lsum[1]}"
+            local_sync_file = Path(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
+            assert local_sync_file.exists()
+            assert local_sync_file.read_text(encoding="utf-8") == f"9 {lsum[1]}"
 
-            remote_sync_file = os.path.join(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
-            assert os.path.exists(remote_sync_file)
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"9 {rsum[1]}"
+            remote_sync_file = Path(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
+            assert remote_sync_file.exists()
+            assert remote_sync_file.read_text(encoding="utf-8") == f"9 {rsum[1]}"
 
             # we record the last sync before transferring files and
             # adding/tagging them, so the revision after finished sync is higher
@@ -653,13 +614,9 @@ def test_sync_tags_files_none_remote(shell):
             rsum = shell.run("notmuch", "count", "--lastmod", env={"NOTMUCH_CONFIG": remote_conf}).stdout.split('\t')
             assert rsum[2] == "9\n"
 
-            out = sync(shell, local_conf, remote_conf).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"9 {lsum[1]}"
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"9 {rsum[1]}"
+            assert parse_sync(sync(shell, local_conf, remote_conf)) == (NO_OP, NO_OP)
+            assert local_sync_file.read_text(encoding="utf-8") == f"9 {lsum[1]}"
+            assert remote_sync_file.read_text(encoding="utf-8") == f"9 {rsum[1]}"
 
 
 def test_sync_files_deleted(shell):
@@ -679,19 +636,15 @@ def test_sync_files_deleted(shell):
             assert rsum[0] == "4"
             assert rsum[2] == "5\n"
 
-            out = sync(shell, local_conf, remote_conf).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
+            assert parse_sync(sync(shell, local_conf, remote_conf)) == (NO_OP, NO_OP)
 
-            local_sync_file = os.path.join(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
-            assert os.path.exists(local_sync_file)
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"5 {lsum[1]}"
+            local_sync_file = Path(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
+            assert local_sync_file.exists()
+            assert local_sync_file.read_text(encoding="utf-8") == f"5 {lsum[1]}"
 
-            remote_sync_file = os.path.join(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
-            assert os.path.exists(remote_sync_file)
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"5 {rsum[1]}"
+            remote_sync_file = Path(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
+            assert remote_sync_file.exists()
+            assert remote_sync_file.read_text(encoding="utf-8") == f"5 {rsum[1]}"
 
             Path.unlink(os.path.join(remote, "mails", "html-only1.eml"))
             assert shell.run("notmuch", "new", env={"NOTMUCH_CONFIG": remote_conf}).returncode == 0
@@ -705,13 +658,9 @@ def test_sync_files_deleted(shell):
             rsum = shell.run("notmuch", "count", "--lastmod", env={"NOTMUCH_CONFIG": remote_conf}).stdout.split('\t')
             assert rsum[2] == "6\n"
 
-            out = sync(shell, local_conf, remote_conf, delete=True).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t1 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"6 {lsum[1]}"
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"6 {rsum[1]}"
+            assert parse_sync(sync(shell, local_conf, remote_conf, delete=True)) == (SyncStats(0, 0, 0, 1, 0, 0), NO_OP)
+            assert local_sync_file.read_text(encoding="utf-8") == f"6 {lsum[1]}"
+            assert remote_sync_file.read_text(encoding="utf-8") == f"6 {rsum[1]}"
 
             assert shell.run("notmuch", "search", "--output=files", "--format=json", "id:87d1dajhgf.fsf@example.net",
                              env={"NOTMUCH_CONFIG": local_conf}).data == [os.path.join(local, "mails", "html-only.eml")]
@@ -743,21 +692,17 @@ def test_sync_message_deleted_local(shell):
             assert rsum[0] == "4"
             assert rsum[2] == "5\n"
 
-            shell.run("notmuch", "tag", "+deleted", "id:1258848661-4660-2-git-send-email-stefan@datenfreihafen.org", env={"NOTMUCH_CONFIG": remote_conf})
+            tag_add(remote, "1258848661-4660-2-git-send-email-stefan@datenfreihafen.org", "deleted")
 
-            out = sync(shell, local_conf, remote_conf).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t1 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
+            assert parse_sync(sync(shell, local_conf, remote_conf)) == (SyncStats(0, 0, 0, 0, 1, 0), NO_OP)
 
-            local_sync_file = os.path.join(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
-            assert os.path.exists(local_sync_file)
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"6 {lsum[1]}"
+            local_sync_file = Path(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
+            assert local_sync_file.exists()
+            assert local_sync_file.read_text(encoding="utf-8") == f"6 {lsum[1]}"
 
-            remote_sync_file = os.path.join(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
-            assert os.path.exists(remote_sync_file)
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"6 {rsum[1]}"
+            remote_sync_file = Path(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
+            assert remote_sync_file.exists()
+            assert remote_sync_file.read_text(encoding="utf-8") == f"6 {rsum[1]}"
 
             Path.unlink(os.path.join(local, "mails", "simple.eml"))
             assert shell.run("notmuch", "new", env={"NOTMUCH_CONFIG": local_conf}).returncode == 0
@@ -771,13 +716,9 @@ def test_sync_message_deleted_local(shell):
             assert lsum[0] == "3"
             assert lsum[2] == "6\n"
 
-            out = sync(shell, local_conf, remote_conf, delete=True).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t1 messages deleted" in out[1]
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"6 {lsum[1]}"
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"6 {rsum[1]}"
+            assert parse_sync(sync(shell, local_conf, remote_conf, delete=True)) == (NO_OP, SyncStats(0, 0, 0, 0, 0, 1))
+            assert local_sync_file.read_text(encoding="utf-8") == f"6 {lsum[1]}"
+            assert remote_sync_file.read_text(encoding="utf-8") == f"6 {rsum[1]}"
 
             assert shell.run("notmuch", "search", "--format=json", "id:1258848661-4660-2-git-send-email-stefan@datenfreihafen.org",
                              env={"NOTMUCH_CONFIG": local_conf}).data == []
@@ -827,19 +768,13 @@ def test_sync_message_deleted_local_failsafe(shell):
             assert rsum[0] == "4"
             assert rsum[2] == "5\n"
 
-            out = sync(shell, local_conf, remote_conf, delete=True).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
+            assert parse_sync(sync(shell, local_conf, remote_conf, delete=True)) == (NO_OP, NO_OP)
             # sync again to recover message
-            out = sync(shell, local_conf, remote_conf, delete=True).split('\n')
-            assert "local:  1 new messages,\t1 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
-            local_sync_file = os.path.join(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"6 {lsum[1]}"
-            remote_sync_file = os.path.join(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"6 {rsum[1]}"
+            assert parse_sync(sync(shell, local_conf, remote_conf, delete=True)) == (SyncStats(1, 1, 0, 0, 0, 0), NO_OP)
+            local_sync_file = Path(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
+            assert local_sync_file.read_text(encoding="utf-8") == f"6 {lsum[1]}"
+            remote_sync_file = Path(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
+            assert remote_sync_file.read_text(encoding="utf-8") == f"6 {rsum[1]}"
 
             assert shell.run("notmuch", "search", "--output=files", "--format=json", "id:1258848661-4660-2-git-send-email-stefan@datenfreihafen.org",
                              env={"NOTMUCH_CONFIG": local_conf}).data == [os.path.join(local, "mails", "simple.eml")]
@@ -873,21 +808,17 @@ def test_sync_message_deleted_remote(shell):
             assert rsum[0] == "4"
             assert rsum[2] == "5\n"
 
-            shell.run("notmuch", "tag", "+deleted", "id:1258848661-4660-2-git-send-email-stefan@datenfreihafen.org", env={"NOTMUCH_CONFIG": local_conf})
+            tag_add(local, "1258848661-4660-2-git-send-email-stefan@datenfreihafen.org", "deleted")
 
-            out = sync(shell, local_conf, remote_conf).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t1 messages with tag changes,\t0 messages deleted" in out[1]
+            assert parse_sync(sync(shell, local_conf, remote_conf)) == (NO_OP, SyncStats(0, 0, 0, 0, 1, 0))
 
-            local_sync_file = os.path.join(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
-            assert os.path.exists(local_sync_file)
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"6 {lsum[1]}"
+            local_sync_file = Path(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
+            assert local_sync_file.exists()
+            assert local_sync_file.read_text(encoding="utf-8") == f"6 {lsum[1]}"
 
-            remote_sync_file = os.path.join(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
-            assert os.path.exists(remote_sync_file)
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"6 {rsum[1]}"
+            remote_sync_file = Path(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
+            assert remote_sync_file.exists()
+            assert remote_sync_file.read_text(encoding="utf-8") == f"6 {rsum[1]}"
 
             Path.unlink(os.path.join(remote, "mails", "simple.eml"))
             assert shell.run("notmuch", "new", env={"NOTMUCH_CONFIG": remote_conf}).returncode == 0
@@ -901,13 +832,9 @@ def test_sync_message_deleted_remote(shell):
             assert rsum[0] == "3"
             assert rsum[2] == "6\n"
 
-            out = sync(shell, local_conf, remote_conf, delete=True).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t1 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"6 {lsum[1]}"
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"6 {rsum[1]}"
+            assert parse_sync(sync(shell, local_conf, remote_conf, delete=True)) == (SyncStats(0, 0, 0, 0, 0, 1), NO_OP)
+            assert local_sync_file.read_text(encoding="utf-8") == f"6 {lsum[1]}"
+            assert remote_sync_file.read_text(encoding="utf-8") == f"6 {rsum[1]}"
 
             assert shell.run("notmuch", "search", "--format=json", "id:1258848661-4660-2-git-send-email-stefan@datenfreihafen.org",
                              env={"NOTMUCH_CONFIG": local_conf}).data == []
@@ -957,19 +884,13 @@ def test_sync_message_deleted_remote_failsafe(shell):
             assert rsum[0] == "3"
             assert rsum[2] == "5\n"
 
-            out = sync(shell, local_conf, remote_conf, delete=True).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
+            assert parse_sync(sync(shell, local_conf, remote_conf, delete=True)) == (NO_OP, NO_OP)
             # sync again to recover message
-            out = sync(shell, local_conf, remote_conf, delete=True).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 1 new messages,\t1 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
-            local_sync_file = os.path.join(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"6 {lsum[1]}"
-            remote_sync_file = os.path.join(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"6 {rsum[1]}"
+            assert parse_sync(sync(shell, local_conf, remote_conf, delete=True)) == (NO_OP, SyncStats(1, 1, 0, 0, 0, 0))
+            local_sync_file = Path(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
+            assert local_sync_file.read_text(encoding="utf-8") == f"6 {lsum[1]}"
+            remote_sync_file = Path(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
+            assert remote_sync_file.read_text(encoding="utf-8") == f"6 {rsum[1]}"
 
             assert shell.run("notmuch", "search", "--output=files", "--format=json", "id:1258848661-4660-2-git-send-email-stefan@datenfreihafen.org",
                              env={"NOTMUCH_CONFIG": local_conf}).data == [os.path.join(local, "mails", "simple.eml")]
@@ -1003,22 +924,18 @@ def test_sync_message_deleted_multiple_and_back(shell):
             assert rsum[0] == "4"
             assert rsum[2] == "5\n"
 
-            shell.run("notmuch", "tag", "+deleted", "id:874llc2bkp.fsf@curie.anarc.at", env={"NOTMUCH_CONFIG": remote_conf})
-            shell.run("notmuch", "tag", "+deleted", "id:1258848661-4660-2-git-send-email-stefan@datenfreihafen.org", env={"NOTMUCH_CONFIG": local_conf})
+            tag_add(remote, "874llc2bkp.fsf@curie.anarc.at", "deleted")
+            tag_add(local, "1258848661-4660-2-git-send-email-stefan@datenfreihafen.org", "deleted")
 
-            out = sync(shell, local_conf, remote_conf).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t1 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t1 messages with tag changes,\t0 messages deleted" in out[1]
+            assert parse_sync(sync(shell, local_conf, remote_conf)) == (SyncStats(0, 0, 0, 0, 1, 0), SyncStats(0, 0, 0, 0, 1, 0))
 
-            local_sync_file = os.path.join(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
-            assert os.path.exists(local_sync_file)
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"7 {lsum[1]}"
+            local_sync_file = Path(local, ".notmuch", f"notmuch-sync-{rsum[1]}")
+            assert local_sync_file.exists()
+            assert local_sync_file.read_text(encoding="utf-8") == f"7 {lsum[1]}"
 
-            remote_sync_file = os.path.join(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
-            assert os.path.exists(remote_sync_file)
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"7 {rsum[1]}"
+            remote_sync_file = Path(remote, ".notmuch", f"notmuch-sync-{lsum[1]}")
+            assert remote_sync_file.exists()
+            assert remote_sync_file.read_text(encoding="utf-8") == f"7 {rsum[1]}"
 
             Path.unlink(os.path.join(local, "mails", "attachment.eml"))
             Path.unlink(os.path.join(remote, "mails", "simple.eml"))
@@ -1035,13 +952,9 @@ def test_sync_message_deleted_multiple_and_back(shell):
                              env={"NOTMUCH_CONFIG": remote_conf}).data == []
             assert Path(os.path.join(local, "mails", "simple.eml")).exists()
 
-            out = sync(shell, local_conf, remote_conf, delete=True).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t1 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t1 messages deleted" in out[1]
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"7 {lsum[1]}"
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"7 {rsum[1]}"
+            assert parse_sync(sync(shell, local_conf, remote_conf, delete=True)) == (SyncStats(0, 0, 0, 0, 0, 1), SyncStats(0, 0, 0, 0, 0, 1))
+            assert local_sync_file.read_text(encoding="utf-8") == f"7 {lsum[1]}"
+            assert remote_sync_file.read_text(encoding="utf-8") == f"7 {rsum[1]}"
 
             assert shell.run("notmuch", "search", "--output=files", "--format=json", "id:874llc2bkp.fsf@curie.anarc.at",
                              env={"NOTMUCH_CONFIG": remote_conf}).data == []
@@ -1064,8 +977,8 @@ def test_sync_message_deleted_multiple_and_back(shell):
             assert rsum[2] == "7\n"
 
             # copy mails back and sync
-            assert shell.run("cp", "test/mails/simple.eml", os.path.join(local, "mails")).returncode == 0
-            assert shell.run("cp", "-r", "test/mails/attachment.eml", os.path.join(remote, "mails")).returncode == 0
+            shutil.copy("test/mails/simple.eml", os.path.join(local, "mails"))
+            shutil.copy("test/mails/attachment.eml", os.path.join(remote, "mails"))
             assert shell.run("notmuch", "new", env={"NOTMUCH_CONFIG": local_conf}).returncode == 0
             assert shell.run("notmuch", "new", env={"NOTMUCH_CONFIG": remote_conf}).returncode == 0
 
@@ -1076,13 +989,9 @@ def test_sync_message_deleted_multiple_and_back(shell):
             assert rsum[0] == "3"
             assert rsum[2] == "8\n"
 
-            out = sync(shell, local_conf, remote_conf, delete=True).split('\n')
-            assert "local:  1 new messages,\t1 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 1 new messages,\t1 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
-            with open(local_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"10 {lsum[1]}"
-            with open(remote_sync_file, "r", encoding="utf-8") as f:
-                assert f.read() == f"9 {rsum[1]}"
+            assert parse_sync(sync(shell, local_conf, remote_conf, delete=True)) == (SyncStats(1, 1, 0, 0, 0, 0), SyncStats(1, 1, 0, 0, 0, 0))
+            assert local_sync_file.read_text(encoding="utf-8") == f"10 {lsum[1]}"
+            assert remote_sync_file.read_text(encoding="utf-8") == f"9 {rsum[1]}"
 
             assert shell.run("notmuch", "search", "--output=files", "--format=json", "id:874llc2bkp.fsf@curie.anarc.at",
                              env={"NOTMUCH_CONFIG": local_conf}).data == [os.path.join(local, "mails", "attachment.eml")]
@@ -1104,9 +1013,7 @@ def test_sync_message_deleted_multiple_and_back(shell):
             assert rsum[0] == "4"
             assert rsum[2] == "9\n"
 
-            out = sync(shell, local_conf, remote_conf, delete=True).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
+            assert parse_sync(sync(shell, local_conf, remote_conf, delete=True)) == (NO_OP, NO_OP)
 
 
 def test_sync_mbsync(shell):
@@ -1130,9 +1037,7 @@ def test_sync_mbsync(shell):
             assert not Path(remote_mbsyncstate).exists()
             assert not Path(remote_uidvalidity).exists()
 
-            out = sync(shell, local_conf, remote_conf, mbsync=True).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
+            assert parse_sync(sync(shell, local_conf, remote_conf, mbsync=True)) == (NO_OP, NO_OP)
 
             assert Path(remote_mbsyncstate).exists()
             assert Path(remote_uidvalidity).exists()
@@ -1146,9 +1051,7 @@ def test_sync_mbsync(shell):
             with open(local_uidvalidity, "r", encoding="utf-8") as f:
                 assert f.read() == "b"
 
-            out = sync(shell, local_conf, remote_conf, mbsync=True).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
+            assert parse_sync(sync(shell, local_conf, remote_conf, mbsync=True)) == (NO_OP, NO_OP)
 
             with open(local_uidvalidity, "r", encoding="utf-8") as f:
                 assert f.read() == "c"
@@ -1157,13 +1060,13 @@ def test_sync_mbsync(shell):
 
             with open(remote_mbsyncstate, "w", encoding="utf-8") as f:
                 f.write("d")
-            time.sleep(0.1)
             with open(local_mbsyncstate, "w", encoding="utf-8") as f:
                 f.write("e")
+            # make sure local is newer without waiting for the clock to tick
+            mtime = os.stat(remote_mbsyncstate).st_mtime + 1
+            os.utime(local_mbsyncstate, (mtime, mtime))
 
-            out = sync(shell, local_conf, remote_conf, mbsync=True).split('\n')
-            assert "local:  0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[0]
-            assert "remote: 0 new messages,\t0 new files,\t0 files copied/moved,\t0 files deleted,\t0 messages with tag changes,\t0 messages deleted" in out[1]
+            assert parse_sync(sync(shell, local_conf, remote_conf, mbsync=True)) == (NO_OP, NO_OP)
 
             with open(local_mbsyncstate, "r", encoding="utf-8") as f:
                 assert f.read() == "e"
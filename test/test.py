@@ -1,139 +1,257 @@
 import pytest
 import os
 import sys
+import hashlib
 import io
 import json
 import stat
 import struct
-from unittest.mock import MagicMock, PropertyMock, call, mock_open, patch
-from tempfile import NamedTemporaryFile, TemporaryDirectory, gettempdir
+import uuid
+from contextlib import contextmanager, nullcontext
+from itertools import repeat
+from unittest.mock import MagicMock, call, mock_open, patch
+from types import SimpleNamespace
+from tempfile import TemporaryDirectory, TemporaryFile, gettempdir
 
 import notmuch2
 
 import src.notmuch_sync as ns
 
-prefix = gettempdir() + os.sep
+tmpdir = gettempdir()
+prefix = tmpdir + os.sep
+
+SHA_MAIL_ONE = hashlib.sha256(b"mail one").hexdigest()
+# framed empty JSON list, what a side sends when it has nothing to send
+EMPTY = b"\x00\x00\x00\x02[]"
+U32 = struct.Struct("!I")
+# mbsync file mtimes are sent as network-order doubles
+F64 = struct.Struct("!d")
+# never created; the mbsync tests mock all file system access below it
+MBSYNC_PREFIX = os.path.join(tmpdir, "notmuch-sync-test-mbsync") + os.sep
+
+MAIL = b"mail one\nmail\n"
+SHA_MAIL = hashlib.sha256(MAIL).hexdigest()
+FRAMED_MAIL = U32.pack(len(MAIL)) + MAIL
+# UUID the other side announces at the start of a sync
+UUID_THEIRS = b"00000000-0000-0000-0000-000000000001"
+
+
+def unique_name():
+    # relative file name that does not exist yet, without touching the disk
+    return "notmuch-sync-test-tmp-" + uuid.uuid4().hex
+
+
+def framed(data):
+    return U32.pack(len(data)) + data
+
+
+def frame(obj):
+    return framed(json.dumps(obj, separators=(",", ":")).encode("utf-8"))
+
+
+class TrackedTags(list):
+    # real list standing in for notmuch2 tag sets that records mutations
+    def __init__(self, tags):
+        super().__init__(tags)
+        self.cleared = 0
+        self.added = []
+        self.discarded = []
+        self.flushed = 0
+
+    def clear(self):
+        self.cleared += 1
+        super().clear()
+
+    def add(self, tag):
+        self.added.append(tag)
+        self.append(tag)
+
+    def discard(self, tag):
+        self.discarded.append(tag)
+        if tag in self:
+            self.remove(tag)
+
+    def to_maildir_flags(self):
+        self.flushed += 1
+
+
+def tag_message(tags):
+    m = SimpleNamespace(messageid="foo", ghost=False, tags=TrackedTags(tags),
+                        frozen=tracked(return_value=nullcontext()))
+    return m, m.tags
+
+
+def tracked(return_value=None, side_effect=None):
+    # lightweight stand-in for MagicMock that only records calls
+    effects = None if side_effect is None else iter(side_effect)
+
+    def fn(*args, **kwargs):
+        fn.mock_calls.append(call(*args, **kwargs))
+        if effects is None:
+            return return_value
+        ret = next(effects)
+        if isinstance(ret, BaseException) or (isinstance(ret, type) and issubclass(ret, BaseException)):
+            raise ret
+        return ret
+
+    fn.mock_calls = []
+    return fn
+
+
+@contextmanager
+def mail_files(*contents):
+    # create temporary mail files with the given contents, yields full paths
+    fnames = [prefix + unique_name() for _ in contents]
+    try:
+        for fname, data in zip(fnames, contents):
+            with open(fname, "wb") as f:
+                f.write(data)
+        yield fnames
+    finally:
+        for fname in fnames:
+            # not Path.unlink, which is patched in some tests
+            if os.path.exists(fname):
+                os.unlink(fname)
+
+
+class FakeHandle:
+    # minimal file handle that only records what is written to it
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class FakeOpen:
+    # stand-in for builtins.open that keeps what was written by file name;
+    # files opened for reading are anonymous temporary files holding
+    # read_data (or read_data[fname] if it is a dict), so that fstat() and
+    # mmap() work on them
+    def __init__(self, read_data=b""):
+        self.read_data = read_data
+        self.mock_calls = []
+        self.written = {}
+
+    def __call__(self, fname, mode="r", *args, **kwargs):
+        self.mock_calls.append(call(fname, mode, *args, **kwargs))
+        if "r" in mode:
+            f = TemporaryFile()
+            f.write(self.read_data[fname] if isinstance(self.read_data, dict) else self.read_data)
+            f.seek(0)
+            return f
+        self.handle = FakeHandle()
+        self.written[fname] = self.handle.writes
+        return self.handle
+
+
+@pytest.fixture
+def nm_database(monkeypatch):
+    # makes notmuch2.Database open the given fake database
+    def use(db):
+        monkeypatch.setattr(notmuch2, "Database", MagicMock(return_value=nullcontext(db)))
+    return use
+
 
 def test_changes():
-    mm = lambda: None
-    mm.messageid = "foo"
-    mm.tags = ["foo", "bar"]
-
-    db = lambda: None
-    rev = lambda: None
-    rev.rev = 124
-    rev.uuid = b'00000000-0000-0000-0000-000000000000'
-    db.messages = MagicMock(return_value=[mm])
-
-    with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f:
-        f.write("123 00000000-0000-0000-0000-000000000000")
-        f.flush()
-        with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f1:
-            f1.write("mail one")
-            f1.flush()
-            with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f2:
-                f2.write("mail two")
-                f2.flush()
-                mm.filenames = MagicMock(return_value=[f1.name, f2.name])
-                changes = ns.get_changes(db, rev, prefix, f.name)
-                assert changes == {"foo": {"tags": ["foo", "bar"], "files":
-                                           [f1.name.removeprefix(prefix), f2.name.removeprefix(prefix)]}}
+    mm = SimpleNamespace(messageid="foo", tags=["foo", "bar"],
+                         filenames=MagicMock(return_value=[prefix + "mail1", prefix + "mail2"]))
+
+    rev = SimpleNamespace(rev=124, uuid=b'00000000-0000-0000-0000-000000000000')
+    db = SimpleNamespace(messages=MagicMock(return_value=[mm]))
+
+    fname = os.path.join(tmpdir, ".notmuch", "notmuch-sync-00000000-0000-0000-0000-000000000001")
+    with patch("builtins.open", mock_open(read_data="123 00000000-0000-0000-0000-000000000000")) as o:
+        changes = ns.get_changes(db, rev, prefix, fname)
+        o.assert_called_once_with(fname, "r", encoding="utf-8")
+    assert changes == {"foo": {"tags": ["foo", "bar"], "files": ["mail1", "mail2"]}}
 
     # expect call for new changes, since next rev number
     db.messages.assert_called_once_with("lastmod:124..")
 
 
 def test_changes_first_sync():
-    mm = lambda: None
-    mm.messageid = "foo"
-    mm.tags = ["foo", "bar"]
-
-    db = lambda: None
-    rev = lambda: None
-    rev.rev = 123
-    db.messages = MagicMock(return_value=[mm])
-
-    # this is only to get a filename that is guaranteed to be unique -- the file
-    # won't exist anymore by the time it is accessed, but that's the point of
-    # this test
-    f = NamedTemporaryFile(mode="r", prefix="notmuch-sync-test-tmp-")
-    f.close()
-    with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f1:
-        f1.write("mail one")
-        f1.flush()
-        with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f2:
-            f2.write("mail two")
-            f2.flush()
-            mm.filenames = MagicMock(return_value=[f1.name, f2.name])
-            changes = ns.get_changes(db, rev, prefix, f.name)
-            assert changes == {"foo": {"tags": ["foo", "bar"], "files":
-                                       [f1.name.removeprefix(prefix), f2.name.removeprefix(prefix)]}}
+    mm = SimpleNamespace(messageid="foo", tags=["foo", "bar"],
+                         filenames=MagicMock(return_value=[prefix + "mail1", prefix + "mail2"]))
+
+    rev = SimpleNamespace(rev=123)
+    db = SimpleNamespace(messages=MagicMock(return_value=[mm]))
+
+    fname = os.path.join(tmpdir, ".notmuch", "notmuch-sync-00000000-0000-0000-0000-000000000001")
+    # no sync state file yet
+    with patch("builtins.open", side_effect=FileNotFoundError):
+        changes = ns.get_changes(db, rev, prefix, fname)
+    assert changes == {"foo": {"tags": ["foo", "bar"], "files": ["mail1", "mail2"]}}
 
     db.messages.assert_called_once_with("lastmod:0..")
 
 
 def test_changes_changed_uuid():
-    db = lambda: None
-    rev = lambda: None
-    rev.rev = 124
-    rev.uuid = b'00000000-0000-0000-0000-000000000000'
-
-    with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f:
-        f.write("123 abc")
-        f.flush()
+    db = SimpleNamespace()
+    rev = SimpleNamespace(rev=124, uuid=b'00000000-0000-0000-0000-000000000000')
+
+    fname = os.path.join(tmpdir, ".notmuch", "notmuch-sync-00000000-0000-0000-0000-000000000001")
+    with patch("builtins.open", mock_open(read_data="123 abc")):
         with pytest.raises(ValueError) as pwe:
-            ns.get_changes(db, rev, prefix, f.name)
+            ns.get_changes(db, rev, prefix, fname)
         assert pwe.type == ValueError
         assert str(pwe.value) == "Last sync with UUID abc, but notmuch DB has UUID 00000000-0000-0000-0000-000000000000, aborting..."
 
 
 def test_changes_later_rev():
-    db = lambda: None
-    rev = lambda: None
-    rev.rev = 122
-    rev.uuid = b'00000000-0000-0000-0000-000000000000'
-
-    with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f:
-        f.write("123 00000000-0000-0000-0000-000000000000")
-        f.flush()
+    db = SimpleNamespace()
+    rev = SimpleNamespace(rev=122, uuid=b'00000000-0000-0000-0000-000000000000')
+
+    fname = os.path.join(tmpdir, ".notmuch", "notmuch-sync-00000000-0000-0000-0000-000000000001")
+    with patch("builtins.open", mock_open(read_data="123 00000000-0000-0000-0000-000000000000")):
         with pytest.raises(ValueError) as pwe:
-            ns.get_changes(db, rev, prefix, f.name)
+            ns.get_changes(db, rev, prefix, fname)
         assert pwe.type == ValueError
         assert str(pwe.value) == "Last sync revision 123 larger than current DB revision 122, aborting..."
 
 
+def test_changes_no_changes():
+    db = SimpleNamespace(messages=MagicMock())
+    rev = SimpleNamespace(rev=123, uuid=b'00000000-0000-0000-0000-000000000000')
+
+    fname = os.path.join(tmpdir, ".notmuch", "notmuch-sync-00000000-0000-0000-0000-000000000001")
+    with patch("builtins.open", mock_open(read_data="123 00000000-0000-0000-0000-000000000000")):
+        assert {} == ns.get_changes(db, rev, prefix, fname)
+    assert db.messages.call_count == 0
+
+
 def test_changes_corrupted_file():
-    db = lambda: None
-    rev = lambda: None
-    rev.rev = 124
-    rev.uuid = b'00000000-0000-0000-0000-000000000000'
-
-    with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f:
-        f.write("123abc")
-        f.flush()
+    db = SimpleNamespace()
+    rev = SimpleNamespace(rev=124, uuid=b'00000000-0000-0000-0000-000000000000')
+
+    fname = os.path.join(tmpdir, ".notmuch", "notmuch-sync-00000000-0000-0000-0000-000000000001")
+    with patch("builtins.open", mock_open(read_data="123abc")):
         with pytest.raises(ValueError) as pwe:
-            ns.get_changes(db, rev, prefix, f.name)
+            ns.get_changes(db, rev, prefix, fname)
         assert pwe.type == ValueError
-        assert str(pwe.value) == f"Sync state file '{f.name}' corrupted, delete to sync from scratch."
+        assert str(pwe.value) == f"Sync state file '{fname}' corrupted, delete to sync from scratch."
 
 
 def test_initial_sync():
-    db = lambda: None
-    rev = lambda: None
-    rev.rev = 123
-    rev.uuid = b'00000000-0000-0000-0000-000000000000'
-    db.revision = MagicMock(return_value=rev)
+    rev = SimpleNamespace(rev=123, uuid=b'00000000-0000-0000-0000-000000000000')
+    db = SimpleNamespace(revision=MagicMock(return_value=rev))
 
-    fname = os.path.join(gettempdir(), ".notmuch", "notmuch-sync-00000000-0000-0000-0000-000000000001")
+    fname = os.path.join(tmpdir, ".notmuch", "notmuch-sync-00000000-0000-0000-0000-000000000001")
     with patch.object(ns, "get_changes", return_value=[]) as gc:
-        istream = io.BytesIO(b"00000000-0000-0000-0000-000000000001\x00\x00\x00\x02[]")
+        istream = io.BytesIO(UUID_THEIRS + EMPTY)
         ostream = io.BytesIO()
         mine, theirs, nchanges, syncname = ns.initial_sync(db, prefix, istream, ostream)
         assert mine == []
         assert theirs == []
         assert nchanges == 0
         assert syncname == fname
-        assert b"00000000-0000-0000-0000-000000000000\x00\x00\x00\x02[]" == ostream.getvalue()
+        assert b"00000000-0000-0000-0000-000000000000" + EMPTY == ostream.getvalue()
 
         gc.assert_called_once_with(db, rev, prefix, fname)
 
@@ -141,1204 +259,637 @@ def test_initial_sync():
 
 
 def test_record_sync():
-    rev = lambda: None
-    rev.rev = 123
-    rev.uuid = b'00000000-0000-0000-0000-000000000000'
+    rev = SimpleNamespace(rev=123, uuid=b'00000000-0000-0000-0000-000000000000')
 
-    fname = os.path.join(gettempdir(), ".notmuch", "notmuch-sync-00000000-0000-0000-0000-000000000001")
-    with patch("builtins.open", mock_open()) as o:
+    fname = os.path.join(tmpdir, ".notmuch", "notmuch-sync-00000000-0000-0000-0000-000000000001")
+    with patch("builtins.open", FakeOpen()) as o:
         ns.record_sync(fname, rev)
-        o.assert_called_once_with(fname, "w", encoding="utf-8")
-        hdl = o()
-        hdl.write.assert_called_once()
-        args = hdl.write.call_args.args
-        assert "123 00000000-0000-0000-0000-000000000000" == args[0]
+        assert o.mock_calls == [call(fname, "w", encoding="utf-8", opener=ns.dsync_opener)]
+        assert o.handle.writes == ["123 00000000-0000-0000-0000-000000000000"]
 
 
-def test_sync_tags_empty():
-    db = lambda: None
-    changes = ns.sync_tags(db, {}, {})
-    assert changes == 0
+def test_record_sync_file():
+    rev = SimpleNamespace(rev=123, uuid=b'00000000-0000-0000-0000-000000000000')
 
+    with TemporaryDirectory() as _tmpdir:
+        fname = os.path.join(_tmpdir, "notmuch-sync-00000000-0000-0000-0000-000000000001")
+        ns.record_sync(fname, rev)
+        with open(fname, encoding="utf-8") as f:
+            assert "123 00000000-0000-0000-0000-000000000000" == f.read()
+        ns.record_sync(fname, rev)
+        with open(fname, encoding="utf-8") as f:
+            assert "123 00000000-0000-0000-0000-000000000000" == f.read()
 
-def test_sync_tags_only_theirs():
-    m = MagicMock()
-    m.frozen = MagicMock()
-    m.frozen.__enter__.return_value = None
-    m.frozen.__exit__.return_value = False
-    m.ghost = False
 
-    mt = MagicMock(spec=list)
-    tags = ["foo", "bar"]
-    mt.__iter__.return_value = iter(tags)
-    mt.__len__.return_value = len(tags)
-    mt.clear = MagicMock()
-    mt.add = MagicMock()
-    mt.to_maildir_flags = MagicMock()
-    type(m).tags = PropertyMock(return_value=mt)
+@pytest.mark.parametrize("mine,theirs,expected_adds", [
+    ({}, {"foo": {"tags": ["bar", "foobar"]}}, ["foobar"]),
+    ({"bar": {"tags": ["tag1", "tag2"]}}, {"foo": {"tags": ["bar", "foobar"]}}, ["foobar"]),
+    ({"foo": {"tags": ["tag1", "tag2"]}}, {"foo": {"tags": ["bar", "foobar"]}}, ["foobar", "tag1", "tag2"]),
+], ids=["only_theirs", "mine_theirs_no_overlap", "mine_theirs_overlap"])
+def test_sync_tags(mine, theirs, expected_adds):
+    m, mt = tag_message(["foo", "bar"])
 
-    db = lambda: None
-    db.find = MagicMock(return_value=m)
+    db = SimpleNamespace(find=tracked(return_value=m))
 
-    changes = ns.sync_tags(db, {}, {"foo": {"tags": ["bar", "foobar"]}})
+    changes = ns.sync_tags(db, mine, theirs)
     assert changes == 1
 
-    db.find.assert_called_once_with("foo")
-    m.frozen.assert_called_once()
-    mt.clear.assert_called_once()
-    assert mt.add.mock_calls == [
-        call("bar"),
-        call("foobar")
-    ]
-    mt.to_maildir_flags.assert_called_once()
-
-
-def test_sync_tags_only_theirs_ghost():
-    m = MagicMock()
-    m.ghost = True
-
-    db = lambda: None
-    db.find = MagicMock(return_value=m)
-
-    changes = ns.sync_tags(db, {}, {"foo": {"tags": ["bar", "foobar"]}})
+    assert db.find.mock_calls == [call("foo")]
+    assert m.frozen.mock_calls == [call()]
+    assert mt.cleared == 0
+    assert mt.discarded == ["foo"]
+    assert mt.added == expected_adds
+    assert sorted(mt) == sorted(expected_adds + ["bar"])
+    assert mt.flushed == 1
+
+
+@pytest.mark.parametrize("mine,theirs,found", [
+    ({}, {}, None),
+    ({"foo": {"tags": ["foo", "bar"]}}, {}, None),
+    ({}, {"foo": {"tags": ["bar", "foobar"]}}, "ghost"),
+    ({}, {"foo": {"tags": ["foo", "bar"]}}, "same_tags"),
+    ({}, {"foo": {"tags": ["bar", "foobar"]}}, "not_found"),
+], ids=["empty", "only_mine", "only_theirs_ghost", "only_theirs_no_changes", "only_theirs_not_found"])
+def test_sync_tags_unchanged(mine, theirs, found):
+    m, mt = tag_message(["foo", "bar"])
+    # what db.find() returns or raises for each case, None if it must not be called
+    results = {
+        None: [],
+        "ghost": [SimpleNamespace(ghost=True)],
+        "same_tags": [m],
+        "not_found": [LookupError()],
+    }
+
+    db = SimpleNamespace(find=tracked(side_effect=results[found]))
+
+    changes = ns.sync_tags(db, mine, theirs)
     assert changes == 0
 
-    db.find.assert_called_once_with("foo")
+    assert db.find.mock_calls == ([] if found is None else [call("foo")])
+    assert mt.cleared == 0
+    assert mt.added == []
+    assert mt.discarded == []
 
 
-def test_sync_tags_only_theirs_no_changes():
-    m = MagicMock()
-
-    mt = MagicMock(spec=list)
-    tags = ["foo", "bar"]
-    mt.__iter__.return_value = iter(tags)
-    mt.__len__.return_value = len(tags)
-    type(m).tags = PropertyMock(return_value=mt)
-
-    db = lambda: None
-    db.find = MagicMock(return_value=m)
-
-    changes = ns.sync_tags(db, {}, {"foo": {"tags": ["foo", "bar"]}})
-    assert changes == 0
-
-    db.find.assert_called_once_with("foo")
-
-
-def test_sync_tags_only_theirs_not_found():
-    db = lambda: None
-    db.find = MagicMock()
-    db.find.side_effect = LookupError()
-
-    changes = ns.sync_tags(db, {}, {"foo": {"tags": ["bar", "foobar"]}})
-    assert changes == 0
-
-    db.find.assert_called_once_with("foo")
-
-
-def test_sync_tags_only_mine():
-    db = lambda: None
-    changes = ns.sync_tags(db, {"foo": {"tags": ["foo", "bar"]}}, {})
-    assert changes == 0
-
+def test_sync_server(monkeypatch, nm_database):
+    args = SimpleNamespace(delete=False, mbsync=False)
 
-def test_sync_tags_mine_theirs_no_overlap():
-    m = MagicMock()
-    m.frozen = MagicMock()
-    m.frozen.__enter__.return_value = None
-    m.frozen.__exit__.return_value = False
-    m.ghost = False
+    rev = SimpleNamespace(rev=124, uuid=b'00000000-0000-0000-0000-000000000000')
+    db = SimpleNamespace(revision=MagicMock(return_value=rev),
+                         default_path=MagicMock(return_value=tmpdir))
 
-    mt = MagicMock(spec=list)
-    tags = ["foo", "bar"]
-    mt.__iter__.return_value = iter(tags)
-    mt.__len__.return_value = len(tags)
-    mt.clear = MagicMock()
-    mt.add = MagicMock()
-    mt.to_maildir_flags = MagicMock()
-    type(m).tags = PropertyMock(return_value=mt)
+    nm_database(db)
 
-    db = lambda: None
-    db.find = MagicMock(return_value=m)
-
-    changes = ns.sync_tags(db, {"bar": {"tags": ["tag1", "tag2"]}}, {"foo": {"tags": ["bar", "foobar"]}})
-    assert changes == 1
-
-    db.find.assert_called_once_with("foo")
-    m.frozen.assert_called_once()
-    mt.clear.assert_called_once()
-    assert mt.add.mock_calls == [
-        call("bar"),
-        call("foobar")
-    ]
-    mt.to_maildir_flags.assert_called_once()
-
-
-def test_sync_tags_mine_theirs_overlap():
-    m = MagicMock()
-    m.frozen = MagicMock()
-    m.frozen.__enter__.return_value = None
-    m.frozen.__exit__.return_value = False
-    m.ghost = False
-
-    mt = MagicMock(spec=list)
-    tags = ["foo", "bar"]
-    mt.__iter__.return_value = iter(tags)
-    mt.__len__.return_value = len(tags)
-    mt.clear = MagicMock()
-    mt.add = MagicMock()
-    mt.to_maildir_flags = MagicMock()
-    type(m).tags = PropertyMock(return_value=mt)
-
-    db = lambda: None
-    db.find = MagicMock(return_value=m)
-
-    changes = ns.sync_tags(db, {"foo": {"tags": ["tag1", "tag2"]}}, {"foo": {"tags": ["bar", "foobar"]}})
-    assert changes == 1
-
-    db.find.assert_called_once_with("foo")
-    m.frozen.assert_called_once()
-    mt.clear.assert_called_once()
-    assert mt.add.mock_calls == [
-        call("bar"),
-        call("foobar"),
-        call("tag1"),
-        call("tag2")
-    ]
-    mt.to_maildir_flags.assert_called_once()
-
-
-def test_sync_server(monkeypatch):
-    args = lambda: None
-    args.delete = False
-    args.mbsync = False
-
-    db = lambda: None
-    rev = lambda: None
-    rev.rev = 124
-    rev.uuid = b'00000000-0000-0000-0000-000000000000'
-    db.revision = MagicMock(return_value=rev)
-    db.default_path = MagicMock(return_value=gettempdir())
-
-    mock_ctx = MagicMock()
-    mock_ctx.__enter__.return_value = db
-    mock_ctx.__exit__.return_value = False
-
-    fname = os.path.join(gettempdir(), ".notmuch", "notmuch-sync-00000000-0000-0000-0000-000000000001")
-    with patch("notmuch2.Database", return_value=mock_ctx):
-        with patch.object(ns, "get_changes", return_value=[]) as gc:
-            with patch("builtins.open", mock_open()) as o:
-                mockio = io.BytesIO(b'00000000-0000-0000-0000-000000000001\x00\x00\x00\x02{}\x00\x00\x00\x02[]\x00\x00\x00\x02[]\x00\x00\x00\x02[]')
-                mockio.buffer = mockio
-                monkeypatch.setattr(sys, "stdin", mockio)
-                ns.sync_remote(args)
-                o.assert_called_once_with(fname, "w", encoding="utf-8")
-                hdl = o()
-                hdl.write.assert_called_once()
-                args = hdl.write.call_args.args
-                assert "124 00000000-0000-0000-0000-000000000000" == args[0]
-            gc.assert_called_once_with(db, rev, prefix, fname)
+    fname = os.path.join(tmpdir, ".notmuch", "notmuch-sync-00000000-0000-0000-0000-000000000001")
+    with patch.object(ns, "get_changes", return_value=[]) as gc:
+        with patch("builtins.open", FakeOpen()) as o:
+            mockio = io.BytesIO(b"".join([UUID_THEIRS, frame({}), EMPTY, EMPTY, EMPTY]))
+            mockio.buffer = mockio
+            monkeypatch.setattr(sys, "stdin", mockio)
+            ns.sync_remote(args)
+            assert o.mock_calls == [call(fname, "w", encoding="utf-8", opener=ns.dsync_opener)]
+            assert o.handle.writes == ["124 00000000-0000-0000-0000-000000000000"]
+        gc.assert_called_once_with(db, rev, prefix, fname)
 
     assert db.revision.call_count == 2
     db.default_path.assert_called_once()
 
 
 def test_missing_files_empty():
-    db = lambda: None
-    istream = io.BytesIO(b"\x00\x00\x00\x02[]\x00\x00\x00\x02[]")
+    db = SimpleNamespace()
+    istream = io.BytesIO(EMPTY * 2)
     ostream = io.BytesIO()
     assert ({}, 0, 0) == ns.get_missing_files(db, prefix, {}, {}, istream, ostream)
-    assert b"\x00\x00\x00\x02[]\x00\x00\x00\x02[]" == ostream.getvalue()
+    assert EMPTY * 2 == ostream.getvalue()
 
 
 def test_missing_files_new():
-    m = MagicMock()
-    m.filenames = MagicMock(return_value=[os.path.join(gettempdir(), "foofile")])
-    m.ghost = False
-    db = lambda: None
-
-    def effect(*args, **kwargs):
-        yield m
-        yield LookupError
-        yield m
-        while True:
-            yield LookupError
-    db.find = MagicMock()
-    db.find.side_effect = effect()
+    m = SimpleNamespace(filenames=MagicMock(return_value=[os.path.join(tmpdir, "foofile")]), ghost=False)
+    db = SimpleNamespace(find=tracked(side_effect=[m, LookupError]))
 
     changes = {"foo": {"tags": ["foo"], "files": ["foofile"]},
                "bar": {"tags": ["bar"], "files": ["barfile"]}}
 
-    istream = io.BytesIO(b"\x00\x00\x00\x02[]\x00\x00\x00\x02[]")
+    istream = io.BytesIO(EMPTY * 2)
     ostream = io.BytesIO()
     exp = {"bar": {"tags": ["bar"], "files": ["barfile"]}}
     assert (exp, 0, 0) == ns.get_missing_files(db, prefix, {}, changes, istream, ostream)
-    assert b"\x00\x00\x00\x02[]\x00\x00\x00\x02[]" == ostream.getvalue()
+    assert EMPTY * 2 == ostream.getvalue()
 
     assert m.filenames.call_count == 2
-    assert db.find.mock_calls == [call('foo'), call('bar'), call('foo'), call('bar')]
+    assert db.find.mock_calls == [call('foo'), call('bar')]
 
 
-def test_missing_files_ghost():
-    m = MagicMock()
-    m.ghost = True
-    db = lambda: None
+def test_missing_files_hash_requested():
+    db = SimpleNamespace()
+    with mail_files(b"mail one", b"mail two") as (f1, f2):
+        f1name = f1.removeprefix(prefix)
+        f2name = f2.removeprefix(prefix)
+        istream = io.BytesIO(frame([f1name, f2name]) + EMPTY)
+        ostream = io.BytesIO()
+        assert ({}, 0, 0) == ns.get_missing_files(db, prefix, {}, {}, istream, ostream)
+    assert EMPTY + frame([SHA_MAIL_ONE, hashlib.sha256(b"mail two").hexdigest()]) == ostream.getvalue()
 
-    db.find = MagicMock(return_value=m)
+
+def test_missing_files_ghost():
+    m = SimpleNamespace(ghost=True)
+    db = SimpleNamespace(find=tracked(return_value=m))
 
     changes = {"bar": {"tags": ["bar"], "files": ["foo"]}}
 
-    istream = io.BytesIO(b"\x00\x00\x00\x02[]\x00\x00\x00\x02[]")
+    istream = io.BytesIO(EMPTY * 2)
     ostream = io.BytesIO()
     exp = {"bar": {"tags": ["bar"], "files": ["foo"]}}
     assert (exp, 0, 0) == ns.get_missing_files(db, prefix, {}, changes, istream, ostream)
-    assert b"\x00\x00\x00\x02[]\x00\x00\x00\x02[]" == ostream.getvalue()
+    assert EMPTY * 2 == ostream.getvalue()
 
-    assert db.find.mock_calls == [ call("bar"), call("bar") ]
+    assert db.find.mock_calls == [ call("bar") ]
 
 
-def test_missing_files_inconsistent_no_move():
-    m = MagicMock()
-    m.ghost = False
-    db = lambda: None
-
-    db.find = MagicMock(return_value=m)
-    db.add = MagicMock(return_value=(m, True))
-    db.remove = MagicMock()
-
-    with patch("shutil.move") as sm:
-        with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f1:
-            with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f2:
-                istream = io.BytesIO(b"\x00\x00\x00\x02[]\x00\x00\x00\x44[\"a983f58ef9ef755c4e5e3755f10cf3e08d9b189b388bcb59d29b56d35d7d6b9d\"]")
-                ostream = io.BytesIO()
-                m.filenames = MagicMock(return_value=[f1.name])
-                f1.write("mail one")
-                f1.flush()
-                f2.write("mail one")
-                f2.flush()
-                f2name = f2.name.removeprefix(prefix)
-                changes_mine = {"foo": {"tags": ["foo"], "files": [f1.name.removeprefix(prefix)]}}
-                changes_theirs = {"foo": {"tags": ["foo"], "files": [f2name]}}
-                assert ({}, 0, 0) == ns.get_missing_files(db, prefix, changes_mine, changes_theirs, istream, ostream, move_on_change=False)
-                tmp = json.dumps([f2name])
-                assert struct.pack("!I", len(tmp)) + tmp.encode("utf-8") + b"\x00\x00\x00\x02[]" == ostream.getvalue()
-
-                assert sm.call_count == 0
-                assert db.add.call_count == 0
-                assert db.remove.call_count == 0
-                assert db.find.mock_calls == [ call("foo"), call("foo") ]
-
-    assert m.filenames.call_count == 3
-
-
-def test_missing_files_inconsistent_move():
-    m = MagicMock()
-    m.ghost = False
-    db = lambda: None
-
-    db.find = MagicMock(return_value=m)
-    db.add = MagicMock(return_value=(m, True))
-    db.remove = MagicMock()
+@pytest.mark.parametrize("move_on_change", [False, True], ids=["no_move", "move"])
+def test_missing_files_inconsistent(move_on_change):
+    m = SimpleNamespace(ghost=False)
+    db = SimpleNamespace(find=tracked(return_value=m), add=MagicMock(return_value=(m, True)),
+                         remove=MagicMock())
 
     with patch("shutil.move") as sm:
-        with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f1:
-            with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f2:
-                istream = io.BytesIO(b"\x00\x00\x00\x02[]\x00\x00\x00\x44[\"a983f58ef9ef755c4e5e3755f10cf3e08d9b189b388bcb59d29b56d35d7d6b9d\"]")
-                ostream = io.BytesIO()
-                m.filenames = MagicMock(return_value=[f1.name])
-                f1.write("mail one")
-                f1.flush()
-                f2.write("mail one")
-                f2.flush()
-                f2name = f2.name.removeprefix(prefix)
-                changes_mine = {"foo": {"tags": ["foo"], "files": [f1.name.removeprefix(prefix)]}}
-                changes_theirs = {"foo": {"tags": ["foo"], "files": [f2name]}}
-                assert ({}, 1, 0) == ns.get_missing_files(db, prefix, changes_mine, changes_theirs, istream, ostream, move_on_change=True)
-                tmp = json.dumps([f2name])
-                assert struct.pack("!I", len(tmp)) + tmp.encode("utf-8") + b"\x00\x00\x00\x02[]" == ostream.getvalue()
-
-                sm.assert_called_once_with(f1.name, f2.name)
-                db.add.assert_called_once_with(f2.name)
-                db.remove.assert_called_once_with(f1.name)
-                assert m.filenames.call_count == 3
-
-    assert db.find.mock_calls == [ call("foo"), call("foo") ]
+        with mail_files(b"mail one", b"mail one") as (f1, f2):
+            istream = io.BytesIO(EMPTY + frame([SHA_MAIL_ONE]))
+            ostream = io.BytesIO()
+            m.filenames = MagicMock(return_value=[f1])
+            f2name = f2.removeprefix(prefix)
+            changes_mine = {"foo": {"tags": ["foo"], "files": [f1.removeprefix(prefix)]}}
+            changes_theirs = {"foo": {"tags": ["foo"], "files": [f2name]}}
+            assert ({}, int(move_on_change), 0) == ns.get_missing_files(db, prefix, changes_mine, changes_theirs, istream, ostream, move_on_change=move_on_change)
+            assert frame([f2name]) + EMPTY == ostream.getvalue()
+
+            assert sm.mock_calls == ([call(f1, f2)] if move_on_change else [])
+            assert db.add.mock_calls == ([call(f2)] if move_on_change else [])
+            assert db.remove.mock_calls == ([call(f1)] if move_on_change else [])
+
+    assert db.find.mock_calls == [ call("foo") ]
+    assert m.filenames.call_count == 2
 
 
 def test_missing_files_multiple_dups():
-    m = MagicMock()
-    m.ghost = False
-    db = lambda: None
-
-    db.find = MagicMock(return_value=m)
-    db.add = MagicMock(return_value=(m, True))
-    db.remove = MagicMock()
+    m = SimpleNamespace(ghost=False)
+    db = SimpleNamespace(find=tracked(return_value=m), add=MagicMock(return_value=(m, True)),
+                         remove=MagicMock())
 
     with patch("shutil.move") as sm:
-        with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f1:
-            with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f2:
-                with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f3:
-                    with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f4:
-                        istream = io.BytesIO(b"\x00\x00\x00\x02[]\x00\x00\x00\x88[\"a983f58ef9ef755c4e5e3755f10cf3e08d9b189b388bcb59d29b56d35d7d6b9d\", \"a983f58ef9ef755c4e5e3755f10cf3e08d9b189b388bcb59d29b56d35d7d6b9d\"]")
-                        ostream = io.BytesIO()
-                        m.filenames = MagicMock(return_value=[f1.name, f2.name])
-                        f1.write("mail one")
-                        f1.flush()
-                        f2.write("mail one")
-                        f2.flush()
-                        f3.write("mail one")
-                        f3.flush()
-                        f4.write("mail one")
-                        f4.flush()
-                        f3name = f3.name.removeprefix(prefix)
-                        f4name = f4.name.removeprefix(prefix)
-                        changes_mine = {}
-                        changes_theirs = {"foo": {"tags": ["foo"], "files": [f3name, f4name]}}
-                        assert ({}, 2, 0) == ns.get_missing_files(db, prefix, changes_mine, changes_theirs, istream, ostream, move_on_change=True)
-                        tmp = json.dumps([f3name, f4name])
-                        assert struct.pack("!I", len(tmp)) + tmp.encode("utf-8") + b"\x00\x00\x00\x02[]" == ostream.getvalue()
-
-                        assert sm.mock_calls == [ call(f1.name, f3.name), call(f2.name, f4.name) ]
-                        assert db.add.mock_calls == [ call(f3.name), call(f4.name) ]
-                        assert db.remove.mock_calls == [ call(f1.name), call(f2.name) ]
-                        assert m.filenames.call_count == 3
-
-    assert db.find.mock_calls == [ call("foo"), call("foo") ]
-
-
-def test_missing_files_multiple_dups_copy_move():
-    m = MagicMock()
-    m.ghost = False
-    db = lambda: None
-
-    db.find = MagicMock(return_value=m)
-    db.add = MagicMock(return_value=(m, True))
-    db.remove = MagicMock()
+        with mail_files(b"mail one", b"mail one", b"mail one", b"mail one") as (f1, f2, f3, f4):
+            istream = io.BytesIO(EMPTY + frame([SHA_MAIL_ONE, SHA_MAIL_ONE]))
+            ostream = io.BytesIO()
+            m.filenames = MagicMock(return_value=[f1, f2])
+            f3name = f3.removeprefix(prefix)
+            f4name = f4.removeprefix(prefix)
+            changes_mine = {}
+            changes_theirs = {"foo": {"tags": ["foo"], "files": [f3name, f4name]}}
+            assert ({}, 2, 0) == ns.get_missing_files(db, prefix, changes_mine, changes_theirs, istream, ostream, move_on_change=True)
+            assert frame([f3name, f4name]) + EMPTY == ostream.getvalue()
+
+            assert sm.mock_calls == [ call(f1, f3), call(f2, f4) ]
+            assert db.add.mock_calls == [ call(f3), call(f4) ]
+            assert db.remove.mock_calls == [ call(f1), call(f2) ]
+            assert m.filenames.call_count == 2
+
+    assert db.find.mock_calls == [ call("foo") ]
+
+
+@patch("shutil.move")
+@patch("shutil.copy")
+def test_missing_files_multiple_dups_copy_move(sc, sm):
+    m = SimpleNamespace(ghost=False)
+    db = SimpleNamespace(find=tracked(return_value=m), add=MagicMock(return_value=(m, True)),
+                         remove=MagicMock())
+
+    with mail_files(b"mail one", b"mail one", b"mail one") as (f1, f2, f3):
+        istream = io.BytesIO(EMPTY + frame([SHA_MAIL_ONE, SHA_MAIL_ONE]))
+        ostream = io.BytesIO()
+        m.filenames = MagicMock(return_value=[f1])
+        f2name = f2.removeprefix(prefix)
+        f3name = f3.removeprefix(prefix)
+        changes_mine = {}
+        changes_theirs = {"foo": {"tags": ["foo"], "files": [f2name, f3name]}}
+        assert ({}, 2, 0) == ns.get_missing_files(db, prefix, changes_mine, changes_theirs, istream, ostream, move_on_change=True)
+        assert frame([f2name, f3name]) + EMPTY == ostream.getvalue()
 
-    with patch("shutil.move") as sm:
-        with patch("shutil.copy") as sc:
-            with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f1:
-                with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f2:
-                    with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f3:
-                        istream = io.BytesIO(b"\x00\x00\x00\x02[]\x00\x00\x00\x88[\"a983f58ef9ef755c4e5e3755f10cf3e08d9b189b388bcb59d29b56d35d7d6b9d\", \"a983f58ef9ef755c4e5e3755f10cf3e08d9b189b388bcb59d29b56d35d7d6b9d\"]")
-                        ostream = io.BytesIO()
-                        m.filenames = MagicMock(return_value=[f1.name])
-                        f1.write("mail one")
-                        f1.flush()
-                        f2.write("mail one")
-                        f2.flush()
-                        f3.write("mail one")
-                        f3.flush()
-                        f2name = f2.name.removeprefix(prefix)
-                        f3name = f3.name.removeprefix(prefix)
-                        changes_mine = {}
-                        changes_theirs = {"foo": {"tags": ["foo"], "files": [f2name, f3name]}}
-                        assert ({}, 2, 0) == ns.get_missing_files(db, prefix, changes_mine, changes_theirs, istream, ostream, move_on_change=True)
-                        tmp = json.dumps([f2name, f3name])
-                        assert struct.pack("!I", len(tmp)) + tmp.encode("utf-8") + b"\x00\x00\x00\x02[]" == ostream.getvalue()
-
-                        assert sm.mock_calls == [ call(f1.name, f2.name) ]
-                        assert sc.mock_calls == [ call(f2.name, f3.name) ]
-                        assert db.add.mock_calls == [ call(f2.name), call(f3.name) ]
-                        assert db.remove.mock_calls == [ call(f1.name) ]
-                        assert m.filenames.call_count == 3
-
-    assert db.find.mock_calls == [ call("foo"), call("foo") ]
+        assert sm.mock_calls == [ call(f1, f2) ]
+        assert sc.mock_calls == [ call(f2, f3) ]
+        assert db.add.mock_calls == [ call(f2), call(f3) ]
+        assert db.remove.mock_calls == [ call(f1) ]
+        assert m.filenames.call_count == 2
 
+    assert db.find.mock_calls == [ call("foo") ]
 
-def test_missing_files_moved():
-    m = MagicMock()
-    m.ghost = False
-    db = lambda: None
 
-    db.find = MagicMock(return_value=m)
-    db.add = MagicMock(return_value=(m, True))
-    db.remove = MagicMock()
+def test_missing_files_moved():
+    m = SimpleNamespace(ghost=False)
+    db = SimpleNamespace(find=tracked(return_value=m), add=MagicMock(return_value=(m, True)),
+                         remove=MagicMock())
 
     with patch("shutil.move") as sm:
-        with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f1:
-            with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f2:
-                istream = io.BytesIO(b"\x00\x00\x00\x02[]\x00\x00\x00\x44[\"a983f58ef9ef755c4e5e3755f10cf3e08d9b189b388bcb59d29b56d35d7d6b9d\"]")
-                ostream = io.BytesIO()
-                m.filenames = MagicMock(return_value=[f1.name])
-                f1.write("mail one")
-                f1.flush()
-                f2name = f2.name.removeprefix(prefix)
-                changes = {"foo": {"tags": ["foo"], "files": [f2name]}}
-                assert ({}, 1, 0) == ns.get_missing_files(db, prefix, {}, changes, istream, ostream)
-                tmp = json.dumps([f2name])
-                assert struct.pack("!I", len(tmp)) + tmp.encode("utf-8") + b"\x00\x00\x00\x02[]" == ostream.getvalue()
-
-                sm.assert_called_once_with(f1.name, f2.name)
-                db.add.assert_called_once_with(f2.name)
-                db.remove.assert_called_once_with(f1.name)
-                assert m.filenames.call_count == 3
-
-    assert db.find.mock_calls == [ call("foo"), call("foo") ]
+        with mail_files(b"mail one", b"") as (f1, f2):
+            istream = io.BytesIO(EMPTY + frame([SHA_MAIL_ONE]))
+            ostream = io.BytesIO()
+            m.filenames = MagicMock(return_value=[f1])
+            f2name = f2.removeprefix(prefix)
+            changes = {"foo": {"tags": ["foo"], "files": [f2name]}}
+            assert ({}, 1, 0) == ns.get_missing_files(db, prefix, {}, changes, istream, ostream)
+            assert frame([f2name]) + EMPTY == ostream.getvalue()
 
+            sm.assert_called_once_with(f1, f2)
+            db.add.assert_called_once_with(f2)
+            db.remove.assert_called_once_with(f1)
+            assert m.filenames.call_count == 2
 
-def test_missing_files_copied():
-    m = MagicMock()
-    m.ghost = False
-    db = lambda: None
+    assert db.find.mock_calls == [ call("foo") ]
 
-    db.find = MagicMock(return_value=m)
-    db.add = MagicMock(return_value=(m, True))
 
-    # this is only to get a filename that is guaranteed to be unique
-    f = NamedTemporaryFile(mode="r", prefix="notmuch-sync-test-tmp-")
-    f.close()
+def test_missing_files_copied():
+    m = SimpleNamespace(ghost=False)
+    db = SimpleNamespace(find=tracked(return_value=m), add=MagicMock(return_value=(m, True)))
+
+    fname = unique_name()
     with patch("shutil.copy") as sc:
-        with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f1:
-            istream = io.BytesIO(b"\x00\x00\x00\x02[]\x00\x00\x00\x88[\"a983f58ef9ef755c4e5e3755f10cf3e08d9b189b388bcb59d29b56d35d7d6b9d\", \"a983f58ef9ef755c4e5e3755f10cf3e08d9b189b388bcb59d29b56d35d7d6b9d\"]")
+        with mail_files(b"mail one") as (f1,):
+            istream = io.BytesIO(EMPTY + frame([SHA_MAIL_ONE, SHA_MAIL_ONE]))
             ostream = io.BytesIO()
-            m.filenames = MagicMock(return_value=[f1.name])
-            f1.write("mail one")
-            f1.flush()
-            fname = f.name.removeprefix(prefix)
-            f1name = f1.name.removeprefix(prefix)
+            m.filenames = MagicMock(return_value=[f1])
+            f1name = f1.removeprefix(prefix)
             changes = {"foo": {"tags": ["foo"], "files": [f1name, fname]}}
             assert ({}, 1, 0) == ns.get_missing_files(db, prefix, {}, changes, istream, ostream)
-            tmp = json.dumps([f1name, fname])
-            assert struct.pack("!I", len(tmp)) + tmp.encode("utf-8") + b"\x00\x00\x00\x02[]" == ostream.getvalue()
-
-            sc.assert_called_once_with(f1.name, f.name)
+            assert frame([f1name, fname]) + EMPTY == ostream.getvalue()
 
-    assert m.filenames.call_count == 3
-    assert db.find.mock_calls == [ call("foo"), call("foo") ]
-    db.add.assert_called_once_with(f.name)
+            sc.assert_called_once_with(f1, prefix + fname)
 
+    assert m.filenames.call_count == 2
+    assert db.find.mock_calls == [ call("foo") ]
+    db.add.assert_called_once_with(prefix + fname)
 
-def test_missing_files_added():
-    m = MagicMock()
-    m.ghost = False
-    db = lambda: None
-
-    db.find = MagicMock(return_value=m)
 
-    with patch("shutil.copy") as sc:
-        with patch("shutil.move") as sm:
-            with patch("pathlib.Path.unlink") as pu:
-                with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f1:
-                    istream = io.BytesIO(b"\x00\x00\x00\x02[]\x00\x00\x00\x4B[\"a983f58ef9ef755c4e5e3755f10cf3e08d9b189b388bcb59d29b56d35d7d6b9d\", \"abc\"]")
-                    ostream = io.BytesIO()
-                    m.filenames = MagicMock(return_value=[f1.name])
-                    f1.write("mail one")
-                    f1.flush()
-                    f1name = f1.name.removeprefix(prefix)
-                    changes = {"foo": {"tags": ["foo"], "files": [f1name, "bar"]}}
-                    exp = {"foo": {"files": ["bar"]}}
-                    assert (exp, 0, 0) == ns.get_missing_files(db, prefix, {}, changes, istream, ostream)
-                    tmp = json.dumps([f1name, "bar"])
-                    assert struct.pack("!I", len(tmp)) + tmp.encode("utf-8") + b"\x00\x00\x00\x02[]" == ostream.getvalue()
-                    assert pu.call_count == 0
-
-            assert sm.call_count == 0
-            assert sc.call_count == 0
-
-    assert db.find.mock_calls == [ call("foo"), call("foo") ]
-    assert m.filenames.call_count == 3
-
-
-def test_missing_files_delete():
-    m = MagicMock()
-    m.ghost = False
-    db = lambda: None
-
-    db.find = MagicMock(return_value=m)
-    db.remove = MagicMock()
+@patch("shutil.copy")
+@patch("shutil.move")
+@patch("pathlib.Path.unlink")
+def test_missing_files_added(pu, sm, sc):
+    m = SimpleNamespace(ghost=False)
+    db = SimpleNamespace(find=tracked(return_value=m))
 
-    with patch("shutil.copy") as sc:
-        with patch("shutil.move") as sm:
-            with patch("pathlib.Path.unlink") as pu:
-                with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f1:
-                    with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f2:
-                        istream = io.BytesIO(b"\x00\x00\x00\x02[]\x00\x00\x00\x02[]")
-                        ostream = io.BytesIO()
-                        m.filenames = MagicMock(return_value=[f1.name, f2.name])
-                        f1.write("mail one")
-                        f1.flush()
-                        f2.write("mail one")
-                        f2.flush()
-                        changes = {"foo": {"tags": ["foo"], "files": [f1.name.removeprefix(prefix)]}}
-                        assert ({}, 0, 1) == ns.get_missing_files(db, prefix, {}, changes, istream, ostream)
-                        assert b"\x00\x00\x00\x02[]\x00\x00\x00\x02[]" == ostream.getvalue()
-                        db.remove.assert_called_once_with(f2.name)
-                        pu.assert_called_once()
-            assert sm.call_count == 0
-            assert sc.call_count == 0
-
-    assert db.find.mock_calls == [ call("foo"), call("foo") ]
+    with mail_files(b"mail one") as (f1,):
+        istream = io.BytesIO(EMPTY + frame([SHA_MAIL_ONE, "abc"]))
+        ostream = io.BytesIO()
+        m.filenames = MagicMock(return_value=[f1])
+        f1name = f1.removeprefix(prefix)
+        changes = {"foo": {"tags": ["foo"], "files": [f1name, "bar"]}}
+        exp = {"foo": {"files": ["bar"]}}
+        assert (exp, 0, 0) == ns.get_missing_files(db, prefix, {}, changes, istream, ostream)
+        assert frame([f1name, "bar"]) + EMPTY == ostream.getvalue()
+        assert pu.call_count == 0
+
+    assert sm.call_count == 0
+    assert sc.call_count == 0
+
+    assert db.find.mock_calls == [ call("foo") ]
     assert m.filenames.call_count == 2
 
 
-def test_missing_files_delete_changed():
-    m = MagicMock()
-    m.ghost = False
-    db = lambda: None
+@pytest.mark.parametrize("changed_mine", [False, True], ids=["unchanged", "changed"])
+@patch("shutil.copy")
+@patch("shutil.move")
+@patch("pathlib.Path.unlink")
+def test_missing_files_delete(pu, sm, sc, changed_mine):
+    m = SimpleNamespace(ghost=False)
+    db = SimpleNamespace(find=tracked(return_value=m), remove=MagicMock())
+
+    with mail_files(b"mail one", b"mail one") as (f1, f2):
+        istream = io.BytesIO(EMPTY * 2)
+        ostream = io.BytesIO()
+        m.filenames = MagicMock(return_value=[f1, f2])
+        changes_theirs = {"foo": {"tags": ["foo"], "files": [f1.removeprefix(prefix)]}}
+        # a local change to the message means the extra file is kept
+        changes_mine = {"foo": {"tags": ["foo"], "files": [f2.removeprefix(prefix)]}} if changed_mine else {}
+        deleted = 0 if changed_mine else 1
+        assert ({}, 0, deleted) == ns.get_missing_files(db, prefix, changes_mine, changes_theirs, istream, ostream)
+        assert EMPTY * 2 == ostream.getvalue()
+        assert db.remove.mock_calls == [call(f2)] * deleted
+        assert pu.call_count == deleted
+    assert sm.call_count == 0
+    assert sc.call_count == 0
+
+    assert db.find.mock_calls == [ call("foo") ]
+    assert m.filenames.call_count == 2
 
-    db.find = MagicMock(return_value=m)
-    db.remove = MagicMock()
 
-    with patch("shutil.copy") as sc:
-        with patch("shutil.move") as sm:
-            with patch("pathlib.Path.unlink") as pu:
-                with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f1:
-                    with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f2:
-                        istream = io.BytesIO(b"\x00\x00\x00\x02[]\x00\x00\x00\x02[]")
-                        ostream = io.BytesIO()
-                        m.filenames = MagicMock(return_value=[f1.name, f2.name])
-                        f1.write("mail one")
-                        f1.flush()
-                        f2.write("mail one")
-                        f2.flush()
-                        changes_theirs = {"foo": {"tags": ["foo"], "files": [f1.name.removeprefix(prefix)]}}
-                        changes_mine = {"foo": {"tags": ["foo"], "files": [f2.name.removeprefix(prefix)]}}
-                        assert ({}, 0, 0) == ns.get_missing_files(db, prefix, changes_mine, changes_theirs, istream, ostream)
-                        assert b"\x00\x00\x00\x02[]\x00\x00\x00\x02[]" == ostream.getvalue()
-                        assert pu.call_count == 0
-            assert sm.call_count == 0
-            assert sc.call_count == 0
+@patch("shutil.move")
+@patch("pathlib.Path.unlink")
+def test_missing_files_copy_delete(pu, sm):
+    m = SimpleNamespace(ghost=False)
+    db = SimpleNamespace(find=tracked(return_value=m), add=MagicMock(), remove=MagicMock())
 
-    assert db.remove.call_count == 0
-    assert db.find.mock_calls == [ call("foo"), call("foo") ]
+    with mail_files(b"mail one", b"mail one", b"not mail one") as (f1, f2, f3):
+        istream = io.BytesIO(EMPTY + frame([SHA_MAIL_ONE]))
+        ostream = io.BytesIO()
+        m.filenames = MagicMock(return_value=[f1, f3])
+        f2name = f2.removeprefix(prefix)
+        changes_theirs = {"foo": {"tags": ["foo"], "files": [f2name]}}
+        assert ({}, 1, 1) == ns.get_missing_files(db, prefix, {}, changes_theirs, istream, ostream)
+        assert frame([f2name]) + EMPTY == ostream.getvalue()
+
+        sm.assert_called_once_with(f1, f2)
+        db.add.assert_called_once_with(f2)
+        assert db.remove.mock_calls == [
+            call(f1),
+            call(f3)
+        ]
+        pu.assert_called_once()
+
+    assert db.find.mock_calls == [ call("foo") ]
     assert m.filenames.call_count == 2
 
 
-def test_missing_files_copy_delete():
-    m = MagicMock()
-    m.ghost = False
-    db = lambda: None
+def test_missing_files_delete_mismatch():
+    m = SimpleNamespace(ghost=False)
+    db = SimpleNamespace(find=tracked(return_value=m), add=MagicMock(return_value=(m, True)),
+                         remove=MagicMock())
 
-    db.find = MagicMock(return_value=m)
-    db.add = MagicMock()
-    db.remove = MagicMock()
+    with patch("pathlib.Path.unlink") as pu:
+        with mail_files(b"mail two", b"mail one") as (f1, f2):
+            istream = io.BytesIO(EMPTY + frame([SHA_MAIL_ONE]))
+            ostream = io.BytesIO()
+            m.filenames = MagicMock(return_value=[f1])
+            f2name = f2.removeprefix(prefix)
+            changes_theirs = {"foo": {"tags": ["foo"], "files": [f2name]}}
+            with pytest.raises(ValueError) as pwe:
+                ns.get_missing_files(db, prefix, {}, changes_theirs, istream, ostream)
+            assert pwe.type == ValueError
+            assert str(pwe.value) == f"Message 'foo' has ['{f2name}'] on remote and different ['{f1.removeprefix(prefix)}'] locally!"
+            assert frame([f2name]) + EMPTY == ostream.getvalue()
+
+            assert db.add.call_count == 0
+            assert pu.call_count == 0
+
+    assert db.find.mock_calls == [ call("foo") ]
+    assert m.filenames.call_count == 2
 
-    with patch("shutil.move") as sm:
-        with patch("pathlib.Path.unlink") as pu:
-            with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f1:
-                with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f2:
-                    with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f3:
-                        istream = io.BytesIO(b"\x00\x00\x00\x02[]\x00\x00\x00\x44[\"a983f58ef9ef755c4e5e3755f10cf3e08d9b189b388bcb59d29b56d35d7d6b9d\"]")
-                        ostream = io.BytesIO()
-                        m.filenames = MagicMock(return_value=[f1.name, f3.name])
-                        f1.write("mail one")
-                        f1.flush()
-                        f2.write("mail one")
-                        f2.flush()
-                        f3.write("not mail one")
-                        f3.flush()
-                        f2name = f2.name.removeprefix(prefix)
-                        changes_theirs = {"foo": {"tags": ["foo"], "files": [f2name]}}
-                        assert ({}, 1, 1) == ns.get_missing_files(db, prefix, {}, changes_theirs, istream, ostream)
-                        tmp = json.dumps([f2name])
-                        assert struct.pack("!I", len(tmp)) + tmp.encode("utf-8") + b"\x00\x00\x00\x02[]" == ostream.getvalue()
-
-                        sm.assert_called_once_with(f1.name, f2.name)
-                        db.add.assert_called_once_with(f2.name)
-                        assert db.remove.mock_calls == [
-                            call(f1.name),
-                            call(f3.name)
-                        ]
-                        pu.assert_called_once()
-
-    assert db.find.mock_calls == [ call("foo"), call("foo") ]
-    assert m.filenames.call_count == 3
 
+# file names as notmuch2 returns them: ASCII, non-ASCII and not valid UTF-8
+# (surrogate-escaped by os.fsdecode())
+JSON_NAMES = ["a/b", "mails/caf\xe9.eml", b"mails/caf\xe9.eml".decode("utf-8", "surrogateescape")]
 
-def test_missing_files_delete_mismatch():
-    m = MagicMock()
-    m.ghost = False
-    db = lambda: None
 
-    db.find = MagicMock(return_value=m)
-    db.add = MagicMock(return_value=(m, True))
-    db.remove = MagicMock()
+def json_backend(backend):
+    return None if backend == "json" else pytest.importorskip("orjson")
 
-    with patch("pathlib.Path.unlink") as pu:
-        with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f1:
-            with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f2:
-                istream = io.BytesIO(b"\x00\x00\x00\x02[]\x00\x00\x00\x44[\"a983f58ef9ef755c4e5e3755f10cf3e08d9b189b388bcb59d29b56d35d7d6b9d\"]")
-                ostream = io.BytesIO()
-                m.filenames = MagicMock(return_value=[f1.name])
-                f1.write("mail two")
-                f1.flush()
-                f2.write("mail one")
-                f2.flush()
-                f2name = f2.name.removeprefix(prefix)
-                changes_theirs = {"foo": {"tags": ["foo"], "files": [f2name]}}
-                with pytest.raises(ValueError) as pwe:
-                    ns.get_missing_files(db, prefix, {}, changes_theirs, istream, ostream)
-                assert pwe.type == ValueError
-                assert str(pwe.value) == f"Message 'foo' has ['{f2name}'] on remote and different ['{f1.name.removeprefix(prefix)}'] locally!"
-                tmp = json.dumps([f2name])
-                assert struct.pack("!I", len(tmp)) + tmp.encode("utf-8") + b"\x00\x00\x00\x02[]" == ostream.getvalue()
 
-                assert db.add.call_count == 0
-                assert pu.call_count == 0
+@pytest.mark.parametrize("backend", ["json", "orjson"])
+def test_json_roundtrip(backend):
+    obj = {"foo": {"tags": ["bar", "foobar"], "files": JSON_NAMES}, ".mbsyncstate": 1.0}
+    with patch.object(ns, "orjson", json_backend(backend)):
+        stream = io.BytesIO()
+        ns.write_json(obj, stream)
+        if backend == "json":
+            assert frame(obj) == stream.getvalue()
+        stream.seek(0)
+        assert obj == ns.read_json(stream)
 
-    assert db.find.mock_calls == [ call("foo"), call("foo") ]
-    assert m.filenames.call_count == 3
 
+@pytest.mark.parametrize("writer,reader", [("json", "orjson"), ("orjson", "json")])
+@pytest.mark.parametrize("name", JSON_NAMES, ids=["ascii", "non_ascii", "surrogate"])
+def test_json_backends_interoperate(writer, reader, name):
+    stream = io.BytesIO()
+    with patch.object(ns, "orjson", json_backend(writer)):
+        ns.write_json([name], stream)
+    stream.seek(0)
+    with patch.object(ns, "orjson", json_backend(reader)):
+        assert [name] == ns.read_json(stream)
 
-def test_send_file():
-    with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-", delete_on_close=False) as f1:
-        f1.write("mail one\n")
-        f1.write("mail\n")
-        f1.close()
-        stream = io.BytesIO()
-        ns.send_file(f1.name, stream)
-        out = stream.getvalue()
-        assert b"\x00\x00\x00\x0email one\nmail\n" == out
 
+@pytest.mark.parametrize("threshold", [1 << 20, 1])
+def test_send_file(threshold):
+    with mail_files(MAIL) as (f1,):
+        with patch.object(ns, "MMAP_THRESHOLD", threshold):
+            stream = io.BytesIO()
+            ns.send_file(f1, stream)
+    assert FRAMED_MAIL == stream.getvalue()
 
 
 def test_recv_file():
     fname = "foo"
-    with patch("builtins.open", mock_open()) as o:
-        stream = io.BytesIO(b"\x00\x00\x00\x0email one\nmail\n")
-        ns.recv_file("foo", stream, "3d0ea99df44f734ef462d85bfeb1352edcb7af528f3386cdaa0939ac27cd8cb3")
-        o.assert_called_once_with("foo", "wb")
-        hdl = o()
-        hdl.write.assert_called_once()
-        args = hdl.write.call_args.args
-        assert b"mail one\nmail\n" == args[0]
+    with patch("builtins.open", FakeOpen()) as o:
+        stream = io.BytesIO(FRAMED_MAIL)
+        ns.recv_file("foo", stream, SHA_MAIL)
+        assert o.mock_calls == [call("foo", "wb")]
+        assert o.handle.writes == [MAIL]
 
 
 def test_recv_file_exists():
     fname = "foo"
-    with patch("builtins.open", mock_open()) as o:
+    with patch("builtins.open", FakeOpen()) as o:
         with patch("pathlib.Path.exists") as pe:
             with patch("pathlib.Path.read_bytes") as prb:
                 pe.return_value = True
                 prb.return_value = b"mail one"
-                stream = io.BytesIO(b"\x00\x00\x00\x0email one\nmail\n")
+                stream = io.BytesIO(FRAMED_MAIL)
                 with pytest.raises(ValueError) as pwe:
-                    ns.recv_file("foo", stream, "3d0ea99df44f734ef462d85bfeb1352edcb7af528f3386cdaa0939ac27cd8cb3")
+                    ns.recv_file("foo", stream, SHA_MAIL)
                 assert pwe.type == ValueError
                 assert str(pwe.value) == "Receiving 'foo', but already exists with different content!"
                 assert pe.call_count == 1
-                assert o.call_count == 0
+                assert o.mock_calls == []
 
 
 def test_sync_files_nothing():
-    db = lambda: None
-    istream = io.BytesIO(b"\x00\x00\x00\x02[]")
+    db = SimpleNamespace()
+    istream = io.BytesIO(EMPTY)
     ostream = io.BytesIO()
     assert (0, 0) == ns.sync_files(db, prefix, {}, istream, ostream)
     out = ostream.getvalue()
-    assert b"\x00\x00\x00\x02[]" == out
+    assert EMPTY == out
 
 
 def test_sync_files_recv_add():
-    istream = io.BytesIO(b"\x00\x00\x00\x02[]\x00\x00\x00\x09mail one\n\x00\x00\x00\x09mail two\n")
+    istream = io.BytesIO(EMPTY + framed(b"mail one\n") + framed(b"mail two\n"))
     ostream = io.BytesIO()
 
-    # this is only to get filenames that are guaranteed to be unique
-    f1 = NamedTemporaryFile(mode="r", prefix="notmuch-sync-test-tmp-")
-    f1.close()
-    f1name = f1.name.removeprefix(prefix)
-    f2 = NamedTemporaryFile(mode="r", prefix="notmuch-sync-test-tmp-")
-    f2.close()
-    f2name = f2.name.removeprefix(prefix)
+    f1name = unique_name()
+    f2name = unique_name()
     missing = {"foo": {"files": [f1name, f2name]}}
 
-    db = lambda: None
-    db.add = MagicMock(return_value=(lambda: None, True))
+    db = SimpleNamespace(add=tracked(return_value=(SimpleNamespace(), True)))
 
-    with patch("builtins.open", mock_open()) as o:
+    with patch("builtins.open", FakeOpen()) as o:
         assert (0, 2) == ns.sync_files(db, prefix, missing, istream, ostream)
-        assert call(f1.name, "wb") in o.mock_calls
-        assert call().write(b'mail one\n') in o.mock_calls
-        assert call(f2.name, "wb") in o.mock_calls
-        assert call().write(b'mail two\n') in o.mock_calls
-        hdl = o()
-        assert hdl.write.call_count == 2
+        assert o.mock_calls == [call(prefix + f1name, "wb"), call(prefix + f2name, "wb")]
+        assert o.written == {prefix + f1name: [b"mail one\n"], prefix + f2name: [b"mail two\n"]}
 
     assert db.add.mock_calls == [
-        call(f1.name),
-        call(f2.name)
+        call(prefix + f1name),
+        call(prefix + f2name)
     ]
-    tmp = json.dumps([f1name, f2name])
-    assert struct.pack("!I", len(tmp)) + tmp.encode("utf-8") == ostream.getvalue()
+    assert frame([f1name, f2name]) == ostream.getvalue()
 
 
 def test_sync_files_recv_new():
-    istream = io.BytesIO(b"\x00\x00\x00\x02[]\x00\x00\x00\x09mail one\n\x00\x00\x00\x09mail two\n")
+    istream = io.BytesIO(EMPTY + framed(b"mail one\n") + framed(b"mail two\n"))
     ostream = io.BytesIO()
 
-    # this is only to get filenames that are guaranteed to be unique
-    f1 = NamedTemporaryFile(mode="r", prefix="notmuch-sync-test-tmp-")
-    f1.close()
-    f1name = f1.name.removeprefix(prefix)
-    f2 = NamedTemporaryFile(mode="r", prefix="notmuch-sync-test-tmp-")
-    f2.close()
-    f2name = f2.name.removeprefix(prefix)
+    f1name = unique_name()
+    f2name = unique_name()
     missing = {"foo": {"tags": ["foo", "bar"], "files": [f1name, f2name]}}
 
-    m = MagicMock()
-    m.frozen = MagicMock()
-    m.frozen.__enter__.return_value = None
-    m.frozen.__exit__.return_value = False
-
-    mt = MagicMock(spec=list)
-    mt.__iter__.return_value = iter([])
-    mt.__len__.return_value = 0
-    mt.clear = MagicMock()
-    mt.add = MagicMock()
-    type(m).tags = PropertyMock(return_value=mt)
+    m, mt = tag_message([])
 
-    db = lambda: None
-    db.add = MagicMock()
-    db.add.side_effect = [(m, False), (m, True)]
+    db = SimpleNamespace(add=tracked(side_effect=[(m, False), (m, True)]))
 
-    with patch("builtins.open", mock_open()) as o:
+    with patch("builtins.open", FakeOpen()) as o:
         assert (1, 2) == ns.sync_files(db, prefix, missing, istream, ostream)
-        assert call(f1.name, "wb") in o.mock_calls
-        assert call().write(b'mail one\n') in o.mock_calls
-        assert call(f2.name, "wb") in o.mock_calls
-        assert call().write(b'mail two\n') in o.mock_calls
-        hdl = o()
-        assert hdl.write.call_count == 2
+        assert o.mock_calls == [call(prefix + f1name, "wb"), call(prefix + f2name, "wb")]
+        assert o.written == {prefix + f1name: [b"mail one\n"], prefix + f2name: [b"mail two\n"]}
 
     assert db.add.mock_calls == [
-        call(f1.name),
-        call(f2.name)
+        call(prefix + f1name),
+        call(prefix + f2name)
     ]
-    m.frozen.assert_called_once()
-    mt.clear.assert_called_once()
-    assert mt.add.mock_calls == [
-        call("foo"),
-        call("bar")
-    ]
-    tmp = json.dumps([f1name, f2name])
-    assert struct.pack("!I", len(tmp)) + tmp.encode("utf-8") == ostream.getvalue()
+    assert m.frozen.mock_calls == [call()]
+    assert mt.cleared == 1
+    assert mt.added == ["foo", "bar"]
+    assert frame([f1name, f2name]) == ostream.getvalue()
 
 
 def test_sync_files_send():
-    db = lambda: None
-    with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f1:
-        f1.write("mail one\n")
-        f1.flush()
-        with NamedTemporaryFile(mode="w+t", prefix="notmuch-sync-test-tmp-") as f2:
-            f2.write("mail two\n")
-            f2.flush()
-            tmp = json.dumps([f1.name, f2.name]).encode("utf-8")
-            istream = io.BytesIO(struct.pack("!I", len(tmp)) + tmp)
-            ostream = io.BytesIO()
-            assert (0, 0) == ns.sync_files(db, prefix, {}, istream, ostream)
-            out = ostream.getvalue()
-            assert b"\x00\x00\x00\x02[]\x00\x00\x00\x09mail one\n\x00\x00\x00\x09mail two\n" == out
-
-
-def test_sync_files_send_recv_add():
-    # this is only to get filenames that are guaranteed to be unique
-    f1 = NamedTemporaryFile(mode="r", prefix="notmuch-sync-test-tmp-")
-    f1.close()
-    f1name = f1.name.removeprefix(prefix)
-    f2 = NamedTemporaryFile(mode="r", prefix="notmuch-sync-test-tmp-")
-    f2.close()
-    f2name = f2.name.removeprefix(prefix)
-    missing = {"foo": {"files": [f1name, f2name]}}
-
-    db = lambda: None
-    db.add = MagicMock(return_value=(lambda: None, True))
-
-    with patch("builtins.open", mock_open(read_data=b"mail three\n")) as o:
-        tmp = json.dumps([f1.name]).encode("utf-8")
-        istream = io.BytesIO(struct.pack("!I", len(tmp)) + tmp + b"\x00\x00\x00\x09mail one\n\x00\x00\x00\x09mail two\n")
+    db = SimpleNamespace()
+    contents = {prefix + "mail1": b"mail one\n", prefix + "mail2": b"mail two\n"}
+    with patch("builtins.open", FakeOpen(read_data=contents)) as o:
+        istream = io.BytesIO(frame(["mail1", "mail2"]))
         ostream = io.BytesIO()
-        assert (0, 2) == ns.sync_files(db, prefix, missing, istream, ostream)
-        assert call(f1.name, "wb") in o.mock_calls
-        assert call().write(b'mail one\n') in o.mock_calls
-        assert call(f2.name, "wb") in o.mock_calls
-        assert call().write(b'mail two\n') in o.mock_calls
-        assert call(f1.name, "rb") in o.mock_calls
-        assert call().write(b'mail one\n') in o.mock_calls
-        hdl = o()
-        assert hdl.write.call_count == 2
-        assert hdl.read.call_count == 1
-
-        tmp = json.dumps([f1name, f2name])
-        assert struct.pack("!I", len(tmp)) + tmp.encode("utf-8") + b"\x00\x00\x00\x0bmail three\n" == ostream.getvalue()
+        assert (0, 0) == ns.sync_files(db, prefix, {}, istream, ostream)
+        assert o.mock_calls == [call(prefix + "mail1", "rb"), call(prefix + "mail2", "rb")]
+    assert EMPTY + framed(b"mail one\n") + framed(b"mail two\n") == ostream.getvalue()
 
-    assert db.add.mock_calls == [
-        call(f1.name),
-        call(f2.name)
-    ]
 
+def test_sync_files_send_flushes_once():
+    class Stream(io.BytesIO):
+        flushes = 0
 
-def test_sync_deletes_local():
-    m1 = lambda: None
-    m1.messageid = "foo"
-    m2 = lambda: None
-    m2.messageid = "bar"
-    m2.filenames = MagicMock(return_value=["barfile"])
-    m2.tags = ["deleted"]
-    m2.ghost = False
-
-    db = lambda: None
-    db.remove = MagicMock()
-    db.find = MagicMock(return_value=m2)
-
-    mock_ctx = MagicMock()
-    mock_ctx.__enter__.return_value = db
-    mock_ctx.__exit__.return_value = False
-
-    with patch("notmuch2.Database", return_value=mock_ctx):
-        with patch("pathlib.Path.unlink") as pu:
-            with patch.object(ns, "get_ids", return_value=["foo", "bar"]) as gi:
-                istream = io.BytesIO(b"\x00\x00\x00\x07[\"foo\"]")
-                ostream = io.BytesIO()
-                assert 1 == ns.sync_deletes_local(prefix, istream, ostream)
-                pu.assert_called_once()
-                gi.assert_called_once_with(prefix)
-
-                out = ostream.getvalue()
-                assert b"\x00\x00\x00\x02[]" == out
-    db.find.assert_called_once_with("bar")
-    db.remove.assert_called_once_with("barfile")
-    m2.filenames.assert_called_once()
-
-
-def test_sync_deletes_local_no_deleted():
-    m1 = lambda: None
-    m1.messageid = "foo"
-    m2 = MagicMock()
-    m2.messageid = "bar"
-    m2.filenames = MagicMock(return_value=["barfile"])
-    mt = MagicMock(spec=list)
-    tags = ["foo"]
-    mt.__iter__.return_value = iter(tags)
-    mt.__len__.return_value = len(tags)
-    mt.add = MagicMock()
-    mt.discard = MagicMock()
-    type(m2).tags = PropertyMock(return_value=mt)
-    m2.frozen = MagicMock()
-    m2.frozen.__enter__.return_value = None
-    m2.frozen.__exit__.return_value = False
-    m2.ghost = False
-
-    db = lambda: None
-    db.remove = MagicMock()
-    db.find = MagicMock(return_value=m2)
-
-    mock_ctx = MagicMock()
-    mock_ctx.__enter__.return_value = db
-    mock_ctx.__exit__.return_value = False
-
-    with patch("notmuch2.Database", return_value=mock_ctx):
-        with patch("pathlib.Path.unlink") as pu:
-            with patch.object(ns, "get_ids", return_value=["foo", "bar"]) as gi:
-                istream = io.BytesIO(b"\x00\x00\x00\x07[\"foo\"]")
-                ostream = io.BytesIO()
-                assert 0 == ns.sync_deletes_local(prefix, istream, ostream)
-                assert pu.call_count == 0
-                gi.assert_called_once_with(prefix)
-
-                out = ostream.getvalue()
-                assert b"\x00\x00\x00\x02[]" == out
-
-    db.find.assert_called_once_with("bar")
-    assert db.remove.call_count == 0
-    assert m2.filenames.call_count == 0
-    mt.add.assert_called_once_with("foo")
-    mt.discard.assert_called_once_with("foo")
-
+        def flush(self):
+            self.flushes += 1
 
-def test_sync_deletes_local_no_deleted_no_check():
-    m1 = lambda: None
-    m1.messageid = "foo"
-    m2 = lambda: None
-    m2.messageid = "bar"
-    m2.filenames = MagicMock(return_value=["barfile"])
-    m2.tags = ["foo"]
-    m2.ghost = False
-
-    db = lambda: None
-    db.remove = MagicMock()
-    db.find = MagicMock(return_value=m2)
-
-    mock_ctx = MagicMock()
-    mock_ctx.__enter__.return_value = db
-    mock_ctx.__exit__.return_value = False
-
-    with patch("notmuch2.Database", return_value=mock_ctx):
-        with patch("pathlib.Path.unlink") as pu:
-            with patch.object(ns, "get_ids", return_value=["foo", "bar"]) as gi:
-                istream = io.BytesIO(b"\x00\x00\x00\x07[\"foo\"]")
-                ostream = io.BytesIO()
-                assert 1 == ns.sync_deletes_local(prefix, istream, ostream, no_check=True)
-                pu.assert_called_once()
-                gi.assert_called_once_with(prefix)
-
-                out = ostream.getvalue()
-                assert b"\x00\x00\x00\x02[]" == out
+    contents = {prefix + "mail1": b"mail one\n", prefix + "mail2": b"mail two\n"}
+    with patch("builtins.open", FakeOpen(read_data=contents)):
+        istream = io.BytesIO(frame(["mail1", "mail2"]))
+        ostream = Stream()
+        ns.sync_files(SimpleNamespace(), prefix, {}, istream, ostream)
+    # one for the (empty) list of requested files, one after sending both files
+    assert ostream.flushes == 2
 
-    db.find.assert_called_once_with("bar")
-    db.remove.assert_called_once_with("barfile")
-    m2.filenames.assert_called_once()
-
-
-def test_sync_deletes_local_ghost():
-    m1 = lambda: None
-    m1.messageid = "foo"
-    m2 = lambda: None
-    m2.messageid = "bar"
-    m2.filenames = MagicMock(return_value=["barfile"])
-    m2.ghost = True
 
-    db = lambda: None
-    db.remove = MagicMock()
-    db.find = MagicMock(return_value=m2)
-
-    mock_ctx = MagicMock()
-    mock_ctx.__enter__.return_value = db
-    mock_ctx.__exit__.return_value = False
-
-    with patch("notmuch2.Database", return_value=mock_ctx):
-        with patch("pathlib.Path.unlink") as pu:
-            with patch.object(ns, "get_ids", return_value=["foo", "bar"]) as gi:
-                istream = io.BytesIO(b"\x00\x00\x00\x07[\"foo\"]")
-                ostream = io.BytesIO()
-                assert 0 == ns.sync_deletes_local(prefix, istream, ostream)
-                assert pu.call_count == 0
-                gi.assert_called_once_with(prefix)
-
-                out = ostream.getvalue()
-                assert b"\x00\x00\x00\x02[]" == out
-
-    db.find.assert_called_once_with("bar")
-    assert db.remove.call_count == 0
-    assert m2.filenames.call_count == 0
-
-
-def test_sync_deletes_local_none():
-    m1 = lambda: None
-    m1.messageid = "foo"
-    m2 = lambda: None
-    m2.messageid = "bar"
-
-    db = lambda: None
-    db.remove = MagicMock()
-
-    mock_ctx = MagicMock()
-    mock_ctx.__enter__.return_value = db
-    mock_ctx.__exit__.return_value = False
-
-    with patch("notmuch2.Database", return_value=mock_ctx):
-        with patch("pathlib.Path.unlink") as pu:
-            with patch.object(ns, "get_ids", return_value=["foo", "bar"]) as gi:
-                istream = io.BytesIO(b"\x00\x00\x00\x0E[\"foo\", \"bar\"]")
-                ostream = io.BytesIO()
-                assert 0 == ns.sync_deletes_local(prefix, istream, ostream)
-                assert pu.call_count == 0
-                gi.assert_called_once_with(prefix)
-
-                out = ostream.getvalue()
-                assert b"\x00\x00\x00\x02[]" == out
+def test_sync_files_send_recv_add():
+    f1name = unique_name()
+    f2name = unique_name()
+    missing = {"foo": {"files": [f1name, f2name]}}
 
-    assert db.remove.call_count == 0
+    db = SimpleNamespace(add=tracked(return_value=(SimpleNamespace(), True)))
 
+    with patch("builtins.open", FakeOpen(read_data=b"mail three\n")) as o:
+        istream = io.BytesIO(frame([prefix + f1name]) + framed(b"mail one\n") + framed(b"mail two\n"))
+        ostream = io.BytesIO()
+        assert (0, 2) == ns.sync_files(db, prefix, missing, istream, ostream)
+        assert len(o.mock_calls) == 3
+        assert call(prefix + f1name, "wb") in o.mock_calls
+        assert call(prefix + f2name, "wb") in o.mock_calls
+        assert call(prefix + f1name, "rb") in o.mock_calls
+        assert o.written == {prefix + f1name: [b"mail one\n"], prefix + f2name: [b"mail two\n"]}
 
-def test_sync_deletes_remote():
-    m1 = lambda: None
-    m1.messageid = "foo"
-    m2 = lambda: None
-    m2.messageid = "bar"
-    m2.filenames = MagicMock(return_value=["barfile"])
-    m2.tags = ["deleted"]
-    m2.ghost = False
-
-    db = lambda: None
-    db.remove = MagicMock()
-    db.find = MagicMock(return_value=m2)
-
-    mock_ctx = MagicMock()
-    mock_ctx.__enter__.return_value = db
-    mock_ctx.__exit__.return_value = False
-
-    with patch("notmuch2.Database", return_value=mock_ctx):
-        with patch("pathlib.Path.unlink") as pu:
-            with patch.object(ns, "get_ids", return_value=["foo", "bar"]) as gi:
-                istream = io.BytesIO(b"\x00\x00\x00\x07[\"bar\"]")
-                ostream = io.BytesIO()
-                assert 1 == ns.sync_deletes_remote(prefix, istream, ostream)
-                pu.assert_called_once()
-                gi.assert_called_once_with(prefix)
-
-                out = ostream.getvalue()
-                assert b"\x00\x00\x00\x0E" in out
-                assert b"\"foo\"" in out
-                assert b"\"bar\"" in out
+        assert frame([f1name, f2name]) + framed(b"mail three\n") == ostream.getvalue()
 
-    db.find.assert_called_once_with("bar")
-    db.remove.assert_called_once_with("barfile")
-    m2.filenames.assert_called_once()
+    assert db.add.mock_calls == [
+        call(prefix + f1name),
+        call(prefix + f2name)
+    ]
 
 
-def test_sync_deletes_remote_no_deleted():
-    m1 = lambda: None
-    m1.messageid = "foo"
-    m2 = MagicMock()
+# function under test, what the other side sends and what we send back, with
+# "bar" existing only on our side
+DELETES_SIDES = {
+    "local": (ns.sync_deletes_local, frame(["foo"]), EMPTY),
+    "remote": (ns.sync_deletes_remote, frame(["bar"]), frame(["foo", "bar"])),
+}
+
+
+@pytest.mark.parametrize("side", ["local", "remote"])
+@pytest.mark.parametrize("tags,ghost,no_check,deleted", [
+    (["deleted"], False, False, True),
+    (["foo"], False, False, False),
+    (["foo"], False, True, True),
+    (["foo"], True, False, False),
+], ids=["deleted", "no_deleted", "no_deleted_no_check", "ghost"])
+@patch("pathlib.Path.unlink")
+@patch.object(ns, "get_ids", return_value=["foo", "bar"])
+def test_sync_deletes(gi, pu, nm_database, tags, ghost, no_check, deleted, side):
+    sync_deletes, received, sent = DELETES_SIDES[side]
+    m2, mt = tag_message(tags)
     m2.messageid = "bar"
-    m2.filenames = MagicMock(return_value=["barfile"])
-    mt = MagicMock(spec=list)
-    tags = ["foo"]
-    mt.__iter__.return_value = iter(tags)
-    mt.__len__.return_value = len(tags)
-    mt.add = MagicMock()
-    mt.discard = MagicMock()
-    type(m2).tags = PropertyMock(return_value=mt)
-    m2.frozen = MagicMock()
-    m2.frozen.__enter__.return_value = None
-    m2.frozen.__exit__.return_value = False
-    m2.ghost = False
-
-    db = lambda: None
-    db.remove = MagicMock()
-    db.find = MagicMock(return_value=m2)
-
-    mock_ctx = MagicMock()
-    mock_ctx.__enter__.return_value = db
-    mock_ctx.__exit__.return_value = False
-
-    with patch("notmuch2.Database", return_value=mock_ctx):
-        with patch("pathlib.Path.unlink") as pu:
-            with patch.object(ns, "get_ids", return_value=["foo", "bar"]) as gi:
-                istream = io.BytesIO(b"\x00\x00\x00\x07[\"bar\"]")
-                ostream = io.BytesIO()
-                assert 0 == ns.sync_deletes_remote(prefix, istream, ostream)
-                assert pu.call_count == 0
-                gi.assert_called_once_with(prefix)
-
-                out = ostream.getvalue()
-                assert b"\x00\x00\x00\x0E" in out
-                assert b"\"foo\"" in out
-                assert b"\"bar\"" in out
+    m2.ghost = ghost
+    m2.filenames = tracked(return_value=["barfile"])
 
-    db.find.assert_called_once_with("bar")
-    assert db.remove.call_count == 0
-    assert m2.filenames.call_count == 0
-    mt.add.assert_called_once_with("foo")
-    mt.discard.assert_called_once_with("foo")
+    db = SimpleNamespace(remove=MagicMock(), find=MagicMock(return_value=m2))
 
+    nm_database(db)
 
-def test_sync_deletes_remote_no_deleted_no_check():
-    m1 = lambda: None
-    m1.messageid = "foo"
-    m2 = lambda: None
-    m2.messageid = "bar"
-    m2.filenames = MagicMock(return_value=["barfile"])
-    m2.tags = ["foo"]
-    m2.ghost = False
-
-    db = lambda: None
-    db.remove = MagicMock()
-    db.find = MagicMock(return_value=m2)
-
-    mock_ctx = MagicMock()
-    mock_ctx.__enter__.return_value = db
-    mock_ctx.__exit__.return_value = False
-
-    with patch("notmuch2.Database", return_value=mock_ctx):
-        with patch("pathlib.Path.unlink") as pu:
-            with patch.object(ns, "get_ids", return_value=["foo", "bar"]) as gi:
-                istream = io.BytesIO(b"\x00\x00\x00\x07[\"bar\"]")
-                ostream = io.BytesIO()
-                assert 1 == ns.sync_deletes_remote(prefix, istream, ostream, no_check=True)
-                pu.assert_called_once()
-                gi.assert_called_once_with(prefix)
-
-                out = ostream.getvalue()
-                assert b"\x00\x00\x00\x0E" in out
-                assert b"\"foo\"" in out
-                assert b"\"bar\"" in out
-
-    db.find.assert_called_once_with("bar")
-    db.remove.assert_called_once_with("barfile")
-    m2.filenames.assert_called_once()
-
+    istream = io.BytesIO(received)
+    ostream = io.BytesIO()
+    assert int(deleted) == sync_deletes(prefix, istream, ostream, no_check=no_check)
+    assert pu.call_count == int(deleted)
+    gi.assert_called_once_with(prefix)
 
-def test_sync_deletes_remote_ghost():
-    m1 = lambda: None
-    m1.messageid = "foo"
-    m2 = lambda: None
-    m2.messageid = "bar"
-    m2.filenames = MagicMock(return_value=["barfile"])
-    m2.ghost = True
-
-    db = lambda: None
-    db.remove = MagicMock()
-    db.find = MagicMock(return_value=m2)
-
-    mock_ctx = MagicMock()
-    mock_ctx.__enter__.return_value = db
-    mock_ctx.__exit__.return_value = False
-
-    with patch("notmuch2.Database", return_value=mock_ctx):
-        with patch("pathlib.Path.unlink") as pu:
-            with patch.object(ns, "get_ids", return_value=["foo", "bar"]) as gi:
-                istream = io.BytesIO(b"\x00\x00\x00\x07[\"bar\"]")
-                ostream = io.BytesIO()
-                assert 0 == ns.sync_deletes_remote(prefix, istream, ostream)
-                assert pu.call_count == 0
-                gi.assert_called_once_with(prefix)
-
-                out = ostream.getvalue()
-                assert b"\x00\x00\x00\x0E" in out
-                assert b"\"foo\"" in out
-                assert b"\"bar\"" in out
+    assert sent == ostream.getvalue()
 
     db.find.assert_called_once_with("bar")
-    assert db.remove.call_count == 0
-    assert m2.filenames.call_count == 0
-
-
-def test_sync_deletes_remote_none():
-    m1 = lambda: None
-    m1.messageid = "foo"
-    m2 = lambda: None
-    m2.messageid = "bar"
-
-    db = lambda: None
-    db.remove = MagicMock()
-
-    mock_ctx = MagicMock()
-    mock_ctx.__enter__.return_value = db
-    mock_ctx.__exit__.return_value = False
-
-    with patch("notmuch2.Database", return_value=mock_ctx):
-        with patch("pathlib.Path.unlink") as pu:
-            with patch.object(ns, "get_ids", return_value=["foo", "bar"]) as gi:
-                istream = io.BytesIO(b"\x00\x00\x00\x02[]")
-                ostream = io.BytesIO()
-                assert 0 == ns.sync_deletes_remote(prefix, istream, ostream)
-                assert pu.call_count == 0
-                gi.assert_called_once_with(prefix)
-
-                out = ostream.getvalue()
-                assert b"\x00\x00\x00\x0E" in out
-                assert b"\"foo\"" in out
-                assert b"\"bar\"" in out
+    if deleted:
+        db.remove.assert_called_once_with("barfile")
+        assert m2.filenames.mock_calls == [call()]
+    else:
+        assert db.remove.call_count == 0
+        assert m2.filenames.mock_calls == []
+    # a message missing on the other side without the deleted tag gets its
+    # tags touched so it is sent back with the next changeset
+    touched = [] if deleted or ghost else ["foo"]
+    assert mt.added == touched
+    assert mt.discarded == touched
+    assert sorted(mt) == sorted(tags)
+
+
+@pytest.mark.parametrize("side,received,sent", [
+    ("local", frame(["foo", "bar"]), EMPTY),
+    ("remote", EMPTY, frame(["foo", "bar"])),
+])
+@patch("pathlib.Path.unlink")
+@patch.object(ns, "get_ids", return_value=["foo", "bar"])
+def test_sync_deletes_none(gi, pu, nm_database, side, received, sent):
+    sync_deletes = DELETES_SIDES[side][0]
+    db = SimpleNamespace(remove=MagicMock(), find=MagicMock())
+
+    nm_database(db)
+
+    istream = io.BytesIO(received)
+    ostream = io.BytesIO()
+    assert 0 == sync_deletes(prefix, istream, ostream)
+    assert pu.call_count == 0
+    gi.assert_called_once_with(prefix)
 
+    assert sent == ostream.getvalue()
+    assert db.find.call_count == 0
     assert db.remove.call_count == 0
 
 
 def test_get_ids():
-    p1 = lambda: None
-    p1.docid = 1
-    p2 = lambda: None
-    p2.docid = 2
-    p3 = lambda: None
-    p3.docid = 3
-    db = lambda: None
-    db.postlist = MagicMock(return_value=[p1, p2, p3])
-    db.get_lastdocid = MagicMock(return_value=6)
-    db.close = MagicMock()
-    doc = lambda: None
-    doc.get_value = MagicMock()
-    doc.get_value.side_effect = [b"a", b"b", b"c"]
-    db.get_document = MagicMock(return_value=doc)
+    p1 = SimpleNamespace(docid=1)
+    p2 = SimpleNamespace(docid=2)
+    p3 = SimpleNamespace(docid=3)
+    doc = SimpleNamespace(get_value=MagicMock(side_effect=[b"a", b"b", b"c"]))
+    db = SimpleNamespace(postlist=MagicMock(return_value=[p1, p2, p3]),
+                         get_lastdocid=MagicMock(return_value=6), close=MagicMock(),
+                         get_document=MagicMock(return_value=doc))
 
     with patch("xapian.Database", return_value=db) as xdb:
         assert ["a", "b", "c"] == ns.get_ids(prefix)
@@ -1351,267 +902,225 @@ def test_get_ids():
 
 
 def test_sync_mbsync_local_nothing():
-    def effect(*args, **kwargs):
-        yield []
-        yield []
+    effect = [[], []]
 
-    with TemporaryDirectory() as _tmpdir:
-        tmpdir = _tmpdir + os.sep
-        with patch("pathlib.Path.rglob") as pr:
-            pr.side_effect = effect()
-            istream = io.BytesIO(b"\x00\x00\x00\x02{}")
-            ostream = io.BytesIO()
-            ns.sync_mbsync_local(tmpdir, istream, ostream)
+    mbsync_prefix = MBSYNC_PREFIX
+    with patch("pathlib.Path.rglob") as pr:
+        pr.side_effect = effect
+        istream = io.BytesIO(frame({}))
+        ostream = io.BytesIO()
+        ns.sync_mbsync_local(mbsync_prefix, istream, ostream)
 
-            out = ostream.getvalue()
-            assert b"\x00\x00\x00\x02[]\x00\x00\x00\x02[]" == out
+        out = ostream.getvalue()
+        assert EMPTY * 2 == out
 
 
 def test_sync_mbsync_local():
-    with TemporaryDirectory() as _tmpdir:
-        tmpdir = _tmpdir + os.sep
-        m1 = MagicMock()
-        m1.__str__ = MagicMock(return_value=(tmpdir + ".uidvalidity"))
-        s1 = lambda: None
-        s1.st_mtime = 1.0
-        m1.stat = MagicMock(return_value=s1)
-        m2 = MagicMock()
-        m2.__str__ = MagicMock(return_value=(tmpdir + ".mbsyncstate"))
-        s2 = lambda: None
-        s2.st_mtime = 0.0
-        m2.stat = MagicMock(return_value=s2)
-
-        def effect_glob(*args, **kwargs):
-            yield [m1]
-            yield [m2]
-        def effect_stat(*args, **kwargs):
-            yield m1
-            yield m2
-
-        with patch("pathlib.Path.rglob") as pr:
-            pr.side_effect = effect_glob()
-            istream = io.BytesIO(b"\x00\x00\x00\x27{\".uidvalidity\":0.0,\".mbsyncstate\":1.0}\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01b")
-            ostream = io.BytesIO()
-            with patch("pathlib.Path.stat") as ps:
-                ps.side_effect = effect_stat()
-                with patch("pathlib.Path.mkdir") as pm:
-                    with patch("os.utime") as ut:
-                        with patch("builtins.open", mock_open(read_data=b"a")) as o:
-                            ns.sync_mbsync_local(tmpdir, istream, ostream)
-                            assert call(tmpdir + ".uidvalidity", "rb") in o.mock_calls
-                            assert call(tmpdir + ".mbsyncstate", "wb") in o.mock_calls
-                            hdl = o()
-                            hdl.read.assert_called_once()
-                            hdl.write.assert_called_once()
-                            args = hdl.write.call_args.args
-                            assert b"b" == args[0]
-                            assert ut.mock_calls == [call(tmpdir + ".mbsyncstate", (0.0, 0.0))]
-
-            assert b"\x00\x00\x00\x10[\".mbsyncstate\"]\x00\x00\x00\x10[\".uidvalidity\"]\x3F\xF0\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01a" == ostream.getvalue()
+    mbsync_prefix = MBSYNC_PREFIX
+    m1 = MagicMock()
+    m1.__str__ = MagicMock(return_value=(mbsync_prefix + ".uidvalidity"))
+    s1 = SimpleNamespace(st_mtime=1.0)
+    m1.stat = MagicMock(return_value=s1)
+    m2 = MagicMock()
+    m2.__str__ = MagicMock(return_value=(mbsync_prefix + ".mbsyncstate"))
+    s2 = SimpleNamespace(st_mtime=0.0)
+    m2.stat = MagicMock(return_value=s2)
+
+    effect_glob = [[m1], [m2]]
+    effect_stat = [m1, m2]
+
+    with patch("pathlib.Path.rglob") as pr:
+        pr.side_effect = effect_glob
+        istream = io.BytesIO(frame({".uidvalidity": 0.0, ".mbsyncstate": 1.0}) + F64.pack(0.0) + framed(b"b"))
+        ostream = io.BytesIO()
+        with patch("pathlib.Path.stat") as ps:
+            ps.side_effect = effect_stat
+            with patch("pathlib.Path.mkdir") as pm:
+                with patch("os.utime") as ut:
+                    with patch("builtins.open", FakeOpen(read_data=b"a")) as o:
+                        ns.sync_mbsync_local(mbsync_prefix, istream, ostream)
+                        assert len(o.mock_calls) == 2
+                        assert call(mbsync_prefix + ".uidvalidity", "rb") in o.mock_calls
+                        assert call(mbsync_prefix + ".mbsyncstate", "wb") in o.mock_calls
+                        assert o.written == {mbsync_prefix + ".mbsyncstate": [b"b"]}
+                        assert ut.mock_calls == [call(mbsync_prefix + ".mbsyncstate", (0.0, 0.0))]
+
+        assert frame([".mbsyncstate"]) + frame([".uidvalidity"]) + F64.pack(1.0) + framed(b"a") == ostream.getvalue()
 
 
 def test_sync_mbsync_local_no_changes():
-    with TemporaryDirectory() as _tmpdir:
-        tmpdir = _tmpdir + os.sep
-        m1 = MagicMock()
-        m1.__str__ = MagicMock(return_value=(tmpdir + ".uidvalidity"))
-        s1 = lambda: None
-        s1.st_mtime = 1
-        m1.stat = MagicMock(return_value=s1)
-        m2 = MagicMock()
-        m2.__str__ = MagicMock(return_value=(tmpdir + ".mbsyncstate"))
-        s2 = lambda: None
-        s2.st_mtime = 1
-        m2.stat = MagicMock(return_value=s2)
-
-        def effect(*args, **kwargs):
-            yield [m1]
-            yield [m2]
-
-        with patch("pathlib.Path.rglob") as pr:
-            pr.side_effect = effect()
-            istream = io.BytesIO(b"\x00\x00\x00\x23{\".uidvalidity\":1,\".mbsyncstate\":1}")
-            ostream = io.BytesIO()
-            with patch("builtins.open", mock_open(read_data=b"a")) as o:
-                ns.sync_mbsync_local(tmpdir, istream, ostream)
-                assert o.call_count == 0
+    mbsync_prefix = MBSYNC_PREFIX
+    m1 = MagicMock()
+    m1.__str__ = MagicMock(return_value=(mbsync_prefix + ".uidvalidity"))
+    s1 = SimpleNamespace(st_mtime=1)
+    m1.stat = MagicMock(return_value=s1)
+    m2 = MagicMock()
+    m2.__str__ = MagicMock(return_value=(mbsync_prefix + ".mbsyncstate"))
+    s2 = SimpleNamespace(st_mtime=1)
+    m2.stat = MagicMock(return_value=s2)
 
-            out = ostream.getvalue()
-            assert b"\x00\x00\x00\x02[]\x00\x00\x00\x02[]" == out
+    effect = [[m1], [m2]]
+
+    with patch("pathlib.Path.rglob") as pr:
+        pr.side_effect = effect
+        istream = io.BytesIO(frame({".uidvalidity": 1, ".mbsyncstate": 1}))
+        ostream = io.BytesIO()
+        with patch("builtins.open", FakeOpen()) as o:
+            ns.sync_mbsync_local(mbsync_prefix, istream, ostream)
+            assert o.mock_calls == []
+
+        out = ostream.getvalue()
+        assert EMPTY * 2 == out
 
 
 def test_sync_mbsync_local_missing():
-    with TemporaryDirectory() as _tmpdir:
-        tmpdir = _tmpdir + os.sep
-        m1 = MagicMock()
-        m1.__str__ = MagicMock(return_value=(tmpdir + ".uidvalidity"))
-        s1 = lambda: None
-        s1.st_mtime = 1.0
-        m1.stat = MagicMock(return_value=s1)
-
-        def effect_glob(*args, **kwargs):
-            yield [m1]
-            yield []
-        def effect_stat(*args, **kwargs):
-            while True:
-                yield m1
-
-        with patch("pathlib.Path.rglob") as pr:
-            pr.side_effect = effect_glob()
-            istream = io.BytesIO(b"\x00\x00\x00\x14{\".mbsyncstate\":1.0}\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01b")
-            ostream = io.BytesIO()
-            with patch("pathlib.Path.stat") as ps:
-                ps.side_effect = effect_stat()
-                with patch("pathlib.Path.mkdir") as pm:
-                    with patch("os.utime") as ut:
-                        with patch("builtins.open", mock_open(read_data=b"a")) as o:
-                            ns.sync_mbsync_local(tmpdir, istream, ostream)
-                            assert call(tmpdir + ".uidvalidity", "rb") in o.mock_calls
-                            assert call(tmpdir + ".mbsyncstate", "wb") in o.mock_calls
-                            hdl = o()
-                            hdl.read.assert_called_once()
-                            hdl.write.assert_called_once()
-                            args = hdl.write.call_args.args
-                            assert b"b" == args[0]
-                            assert ut.mock_calls == [call(tmpdir + ".mbsyncstate", (0.0, 0.0))]
-
-            assert b"\x00\x00\x00\x10[\".mbsyncstate\"]\x00\x00\x00\x10[\".uidvalidity\"]\x3F\xF0\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01a" == ostream.getvalue()
+    mbsync_prefix = MBSYNC_PREFIX
+    m1 = MagicMock()
+    m1.__str__ = MagicMock(return_value=(mbsync_prefix + ".uidvalidity"))
+    s1 = SimpleNamespace(st_mtime=1.0)
+    m1.stat = MagicMock(return_value=s1)
+
+    effect_glob = [[m1], []]
+    effect_stat = repeat(m1)
+
+    with patch("pathlib.Path.rglob") as pr:
+        pr.side_effect = effect_glob
+        istream = io.BytesIO(frame({".mbsyncstate": 1.0}) + F64.pack(0.0) + framed(b"b"))
+        ostream = io.BytesIO()
+        with patch("pathlib.Path.stat") as ps:
+            ps.side_effect = effect_stat
+            with patch("pathlib.Path.mkdir") as pm:
+                with patch("os.utime") as ut:
+                    with patch("builtins.open", FakeOpen(read_data=b"a")) as o:
+                        ns.sync_mbsync_local(mbsync_prefix, istream, ostream)
+                        assert len(o.mock_calls) == 2
+                        assert call(mbsync_prefix + ".uidvalidity", "rb") in o.mock_calls
+                        assert call(mbsync_prefix + ".mbsyncstate", "wb") in o.mock_calls
+                        assert o.written == {mbsync_prefix + ".mbsyncstate": [b"b"]}
+                        assert ut.mock_calls == [call(mbsync_prefix + ".mbsyncstate", (0.0, 0.0))]
+
+        assert frame([".mbsyncstate"]) + frame([".uidvalidity"]) + F64.pack(1.0) + framed(b"a") == ostream.getvalue()
 
 
 def test_sync_mbsync_remote_nothing():
-    def effect(*args, **kwargs):
-        yield []
-        yield []
+    effect = [[], []]
 
-    with TemporaryDirectory() as _tmpdir:
-        tmpdir = _tmpdir + os.sep
-        with patch("pathlib.Path.rglob") as pr:
-            pr.side_effect = effect()
-            istream = io.BytesIO(b"\x00\x00\x00\x02[]\x00\x00\x00\x02[]")
-            ostream = io.BytesIO()
-            ns.sync_mbsync_remote(tmpdir, istream, ostream)
+    mbsync_prefix = MBSYNC_PREFIX
+    with patch("pathlib.Path.rglob") as pr:
+        pr.side_effect = effect
+        istream = io.BytesIO(EMPTY * 2)
+        ostream = io.BytesIO()
+        ns.sync_mbsync_remote(mbsync_prefix, istream, ostream)
 
-            out = ostream.getvalue()
-            assert b"\x00\x00\x00\x02{}" == out
+        out = ostream.getvalue()
+        assert frame({}) == out
 
 
 def test_sync_mbsync_remote():
-    with TemporaryDirectory() as _tmpdir:
-        tmpdir = _tmpdir + os.sep
-        m1 = MagicMock()
-        m1.__str__ = MagicMock(return_value=(tmpdir + ".uidvalidity"))
-        s1 = lambda: None
-        s1.st_mtime = 0.0
-        m1.stat = MagicMock(return_value=s1)
-        m2 = MagicMock()
-        m2.__str__ = MagicMock(return_value=(tmpdir + ".mbsyncstate"))
-        s2 = lambda: None
-        s2.st_mtime = 1.0
-        m2.stat = MagicMock(return_value=s2)
-
-        def effect_glob(*args, **kwargs):
-            yield [m1]
-            yield [m2]
-        def effect_stat(*args, **kwargs):
-            yield m1
-            yield m2
-            yield m1
-            yield m2
-
-        with patch("pathlib.Path.rglob") as pr:
-            pr.side_effect = effect_glob()
-            istream = io.BytesIO(b"\x00\x00\x00\x10[\".mbsyncstate\"]\x00\x00\x00\x10[\".uidvalidity\"]\x3F\xF0\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01a")
-            ostream = io.BytesIO()
-            with patch("pathlib.Path.stat") as ps:
-                ps.side_effect = effect_stat()
-                with patch("pathlib.Path.mkdir") as pm:
-                    with patch("os.utime") as ut:
-                        with patch("builtins.open", mock_open(read_data=b"b")) as o:
-                            ns.sync_mbsync_remote(tmpdir, istream, ostream)
-                            assert call(tmpdir + ".uidvalidity", "wb") in o.mock_calls
-                            assert call(tmpdir + ".mbsyncstate", "rb") in o.mock_calls
-                            hdl = o()
-                            hdl.read.assert_called_once()
-                            hdl.write.assert_called_once()
-                            args = hdl.write.call_args.args
-                            assert b"a" == args[0]
-                            assert ut.mock_calls == [call(tmpdir + ".uidvalidity", (1.0, 1.0))]
-
-                out = ostream.getvalue()
-                assert b"\x00\x00\x00\x2A{\".uidvalidity\": 0.0, \".mbsyncstate\": 1.0}\x3F\xF0\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01b" == out
+    mbsync_prefix = MBSYNC_PREFIX
+    m1 = MagicMock()
+    m1.__str__ = MagicMock(return_value=(mbsync_prefix + ".uidvalidity"))
+    s1 = SimpleNamespace(st_mtime=0.0)
+    m1.stat = MagicMock(return_value=s1)
+    m2 = MagicMock()
+    m2.__str__ = MagicMock(return_value=(mbsync_prefix + ".mbsyncstate"))
+    s2 = SimpleNamespace(st_mtime=1.0)
+    m2.stat = MagicMock(return_value=s2)
 
+    effect_glob = [[m1], [m2]]
+    effect_stat = [m1, m2, m1, m2]
 
-def test_sync_mbsync_remote_no_changes():
-    with TemporaryDirectory() as _tmpdir:
-        tmpdir = _tmpdir + os.sep
-        m1 = MagicMock()
-        m1.__str__ = MagicMock(return_value=(tmpdir + ".uidvalidity"))
-        s1 = lambda: None
-        s1.st_mtime = 1
-        m1.stat = MagicMock(return_value=s1)
-        m2 = MagicMock()
-        m2.__str__ = MagicMock(return_value=(tmpdir + ".mbsyncstate"))
-        s2 = lambda: None
-        s2.st_mtime = 1
-        m2.stat = MagicMock(return_value=s2)
-
-        def effect(*args, **kwargs):
-            yield [m1]
-            yield [m2]
-
-        with patch("pathlib.Path.rglob") as pr:
-            pr.side_effect = effect()
-            istream = io.BytesIO(b"\x00\x00\x00\x02[]\x00\x00\x00\x02[]")
-            ostream = io.BytesIO()
-            with patch("builtins.open", mock_open(read_data=b"a")) as o:
-                ns.sync_mbsync_remote(tmpdir, istream, ostream)
-                assert o.call_count == 0
+    with patch("pathlib.Path.rglob") as pr:
+        pr.side_effect = effect_glob
+        istream = io.BytesIO(frame([".mbsyncstate"]) + frame([".uidvalidity"]) + F64.pack(1.0) + framed(b"a"))
+        ostream = io.BytesIO()
+        with patch("pathlib.Path.stat") as ps:
+            ps.side_effect = effect_stat
+            with patch("pathlib.Path.mkdir") as pm:
+                with patch("os.utime") as ut:
+                    with patch("builtins.open", FakeOpen(read_data=b"b")) as o:
+                        ns.sync_mbsync_remote(mbsync_prefix, istream, ostream)
+                        assert len(o.mock_calls) == 2
+                        assert call(mbsync_prefix + ".uidvalidity", "wb") in o.mock_calls
+                        assert call(mbsync_prefix + ".mbsyncstate", "rb") in o.mock_calls
+                        assert o.written == {mbsync_prefix + ".uidvalidity": [b"a"]}
+                        assert ut.mock_calls == [call(mbsync_prefix + ".uidvalidity", (1.0, 1.0))]
 
             out = ostream.getvalue()
-            assert b"\x00\x00\x00\x26{\".uidvalidity\": 1, \".mbsyncstate\": 1}" == out
+            assert frame({".uidvalidity": 0.0, ".mbsyncstate": 1.0}) + F64.pack(1.0) + framed(b"b") == out
 
 
-def test_sync_mbsync_remote_missing():
-    with TemporaryDirectory() as _tmpdir:
-        tmpdir = _tmpdir + os.sep
-        m1 = MagicMock()
-        m1.__str__ = MagicMock(return_value=(tmpdir + ".uidvalidity"))
-        s1 = lambda: None
-        s1.st_mtime = 1.0
-        m1.stat = MagicMock(return_value=s1)
-
-        def effect_glob(*args, **kwargs):
-            yield [m1]
-            yield []
-        def effect_stat(*args, **kwargs):
-            while True:
-                yield m1
-
-        with patch("pathlib.Path.rglob") as pr:
-            pr.side_effect = effect_glob()
-            istream = io.BytesIO(b"\x00\x00\x00\x10[\".mbsyncstate\"]\x00\x00\x00\x10[\".uidvalidity\"]\x3F\xF0\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01b")
-            ostream = io.BytesIO()
-            with patch("pathlib.Path.stat") as ps:
-                ps.side_effect = effect_stat()
-                with patch("pathlib.Path.mkdir") as pm:
-                    with patch("os.utime") as ut:
-                        with patch("builtins.open", mock_open(read_data=b"a")) as o:
-                            ns.sync_mbsync_remote(tmpdir, istream, ostream)
-                            assert call(tmpdir + ".uidvalidity", "wb") in o.mock_calls
-                            assert call(tmpdir + ".mbsyncstate", "rb") in o.mock_calls
-                            hdl = o()
-                            hdl.read.assert_called_once()
-                            hdl.write.assert_called_once()
-                            args = hdl.write.call_args.args
-                            assert b"b" == args[0]
-                            assert ut.mock_calls == [call(tmpdir + ".uidvalidity", (1.0, 1.0))]
+def test_sync_mbsync_remote_no_changes():
+    mbsync_prefix = MBSYNC_PREFIX
+    m1 = MagicMock()
+    m1.__str__ = MagicMock(return_value=(mbsync_prefix + ".uidvalidity"))
+    s1 = SimpleNamespace(st_mtime=1)
+    m1.stat = MagicMock(return_value=s1)
+    m2 = MagicMock()
+    m2.__str__ = MagicMock(return_value=(mbsync_prefix + ".mbsyncstate"))
+    s2 = SimpleNamespace(st_mtime=1)
+    m2.stat = MagicMock(return_value=s2)
 
-            out = ostream.getvalue()
-            assert b"\x00\x00\x00\x15{\".uidvalidity\": 1.0}\x3F\xF0\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01a" == out
+    effect = [[m1], [m2]]
+
+    with patch("pathlib.Path.rglob") as pr:
+        pr.side_effect = effect
+        istream = io.BytesIO(EMPTY * 2)
+        ostream = io.BytesIO()
+        with patch("builtins.open", FakeOpen()) as o:
+            ns.sync_mbsync_remote(mbsync_prefix, istream, ostream)
+            assert o.mock_calls == []
 
+        out = ostream.getvalue()
+        assert frame({".uidvalidity": 1, ".mbsyncstate": 1}) == out
 
-def test_digest():
-    assert "2c26b46b68ffc68ff99b453c1d30413413422d706483bfa0f98a5e886266e7ae" == ns.digest(b"foo")
-    assert "578f2f7c0b2e8ea5be4c8d245b07dec37c62ce4644fadb2a5c23839b39d6c260" == ns.digest(b"foo\nbar\nfoobar")
-    assert "578f2f7c0b2e8ea5be4c8d245b07dec37c62ce4644fadb2a5c23839b39d6c260" == ns.digest(b"foo\nbar\nX-TUID: bla\nfoobar")
-    assert "578f2f7c0b2e8ea5be4c8d245b07dec37c62ce4644fadb2a5c23839b39d6c260" == ns.digest(b"foo\nbar\nX-TUID: blarg\nfoobar")
+
+def test_sync_mbsync_remote_missing():
+    mbsync_prefix = MBSYNC_PREFIX
+    m1 = MagicMock()
+    m1.__str__ = MagicMock(return_value=(mbsync_prefix + ".uidvalidity"))
+    s1 = SimpleNamespace(st_mtime=1.0)
+    m1.stat = MagicMock(return_value=s1)
+
+    effect_glob = [[m1], []]
+    effect_stat = repeat(m1)
+
+    with patch("pathlib.Path.rglob") as pr:
+        pr.side_effect = effect_glob
+        istream = io.BytesIO(frame([".mbsyncstate"]) + frame([".uidvalidity"]) + F64.pack(1.0) + framed(b"b"))
+        ostream = io.BytesIO()
+        with patch("pathlib.Path.stat") as ps:
+            ps.side_effect = effect_stat
+            with patch("pathlib.Path.mkdir") as pm:
+                with patch("os.utime") as ut:
+                    with patch("builtins.open", FakeOpen(read_data=b"a")) as o:
+                        ns.sync_mbsync_remote(mbsync_prefix, istream, ostream)
+                        assert len(o.mock_calls) == 2
+                        assert call(mbsync_prefix + ".uidvalidity", "wb") in o.mock_calls
+                        assert call(mbsync_prefix + ".mbsyncstate", "rb") in o.mock_calls
+                        assert o.written == {mbsync_prefix + ".uidvalidity": [b"b"]}
+                        assert ut.mock_calls == [call(mbsync_prefix + ".uidvalidity", (1.0, 1.0))]
+
+        out = ostream.getvalue()
+        assert frame({".uidvalidity": 1.0}) + F64.pack(1.0) + framed(b"a") == out
+
+
+@pytest.mark.parametrize("data,expected", [
+    (b"foo", "2c26b46b68ffc68ff99b453c1d30413413422d706483bfa0f98a5e886266e7ae"),
+    (b"foo\nbar\nfoobar", "578f2f7c0b2e8ea5be4c8d245b07dec37c62ce4644fadb2a5c23839b39d6c260"),
+], ids=["foo", "multiline"])
+def test_digest(data, expected):
+    assert expected == ns.digest(data)
+    assert hashlib.sha256(data).hexdigest() == ns.digest(data)
+
+
+@pytest.mark.parametrize("tuid", [b"bla", b"blarg", b""])
+def test_digest_strips_tuid(tuid):
+    assert ns.digest(b"foo\nbar\nfoobar") == ns.digest(b"foo\nbar\nX-TUID: " + tuid + b"\nfoobar")
+
+
+@pytest.mark.parametrize("threshold", [1 << 20, 1])
+def test_digest_file(threshold):
+    with mail_files(b"foo\nbar\nX-TUID: bla\nfoobar") as (f1,):
+        with patch.object(ns, "MMAP_THRESHOLD", threshold):
+            assert "578f2f7c0b2e8ea5be4c8d245b07dec37c62ce4644fadb2a5c23839b39d6c260" == ns.digest_file(f1)